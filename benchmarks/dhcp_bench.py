@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Jeffery Harrell <jefferyharrell@gmail.com>
+# See file 'LICENSE' for use and warranty information.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for the DHCP plugin.
+
+Runs the plugin's callbacks against an in-memory stand-in for ldap2 loaded
+with a generated cn=dhcp tree, and prints latency and LDAP call counts per
+scenario as JSON. Run it on an IPA server with the plugin installed:
+
+    python benchmarks/dhcp_bench.py --sizes 10000,100000 --output run.json
+
+Latency is reported twice: the total, and the part spent inside the fake
+backend. The difference is the time spent in the plugin itself; the call
+counts are what a real directory server would see.
+"""
+
+
+#### Imports ##################################################################
+
+
+import argparse
+import json
+import re
+import sys
+import time
+
+from ipalib import api, errors
+from ipalib.request import destroy_context
+from ipapython.dn import DN
+
+
+#### Fake ldap2 ###############################################################
+
+
+class FakeEntry(object):
+
+    # Just enough of ipaldap.LDAPEntry: case-insensitive attribute names,
+    # list values and a dn.
+
+    def __init__(self, dn, attrs=None):
+        self.dn = dn
+        self._attrs = {}
+        for (name, value) in (attrs or {}).items():
+            self[name] = value
+
+
+    def __getitem__(self, name):
+        return self._attrs[name.lower()]
+
+
+    def __setitem__(self, name, value):
+        if value is None:
+            value = []
+        elif not isinstance(value, (list, tuple)):
+            value = [value]
+        self._attrs[name.lower()] = list(value)
+
+
+    def __delitem__(self, name):
+        del self._attrs[name.lower()]
+
+
+    def __contains__(self, name):
+        return name.lower() in self._attrs
+
+
+    def __iter__(self):
+        return iter(self._attrs)
+
+
+    def get(self, name, default=None):
+        return self._attrs.get(name.lower(), default)
+
+
+    def keys(self):
+        return self._attrs.keys()
+
+
+    def items(self):
+        return self._attrs.items()
+
+
+    def values(self):
+        return self._attrs.values()
+
+
+    def copy(self, attrs_list=None):
+        entry = FakeEntry(self.dn)
+        for (name, value) in self._attrs.items():
+            if attrs_list is None or '*' in attrs_list or name in attrs_list:
+                entry._attrs[name] = list(value)
+        return entry
+
+
+def parse_filter(text):
+
+    # Parse an LDAP filter into nested tuples: ('&', [...]), ('|', [...]),
+    # ('!', node) or (operator, attribute, value).
+
+    def parse(pos):
+        assert text[pos] == '('
+        pos += 1
+        if text[pos] in '&|':
+            op = text[pos]
+            pos += 1
+            children = []
+            while text[pos] == '(':
+                (child, pos) = parse(pos)
+                children.append(child)
+            return ((op, children), pos + 1)
+        if text[pos] == '!':
+            (child, pos) = parse(pos + 1)
+            return (('!', child), pos + 1)
+        end = text.index(')', pos)
+        m = re.match(r'([^=<>~]+)(>=|<=|=)(.*)$', text[pos:end])
+        return ((m.group(2), m.group(1).lower(), m.group(3)), end + 1)
+
+    return parse(0)[0]
+
+
+def unescape(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})', lambda m: unichr(int(m.group(1), 16)), value)
+
+
+def match_filter(node, entry):
+    op = node[0]
+    if op == '&':
+        return all(match_filter(c, entry) for c in node[1])
+    if op == '|':
+        return any(match_filter(c, entry) for c in node[1])
+    if op == '!':
+        return not match_filter(node[1], entry)
+
+    (attr, value) = (node[1], node[2])
+    values = [unicode(v).lower() for v in entry.get(attr, [])]
+    if op == '=' and value == '*':
+        return bool(values)
+    if op == '=' and '*' in value:
+        pattern = '.*'.join(re.escape(unescape(p).lower()) for p in value.split('*'))
+        return any(re.match(pattern + '$', v) for v in values)
+
+    value = unescape(value).lower()
+    if op == '=':
+        return value in values
+    for v in values:
+        (a, b) = (v, value)
+        if a.isdigit() and b.isdigit():
+            (a, b) = (int(a), int(b))
+        if (op == '>=' and a >= b) or (op == '<=' and a <= b):
+            return True
+    return False
+
+
+def timed(method):
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        self.calls[method.__name__] += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.elapsed += time.time() - start
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class FakeLDAP(object):
+
+    # In-memory stand-in for ipaserver.plugins.ldap2 covering the calls the
+    # DHCP plugin makes. Every call is counted, and the time spent in here
+    # is accumulated so it can be told apart from the plugin's own time.
+
+    SCOPE_BASE = 0
+    SCOPE_ONELEVEL = 1
+    SCOPE_SUBTREE = 2
+
+    MATCH_ALL = '&'
+    MATCH_ANY = '|'
+    MATCH_NONE = '!'
+
+    def __init__(self):
+        self.entries = {}
+        self.children = {}
+        self.reset_counters()
+
+
+    def reset_counters(self):
+        self.calls = dict(
+            get_entry=0, get_entries=0, find_entries=0,
+            add_entry=0, update_entry=0, delete_entry=0,
+            entries_read=0
+        )
+        self.elapsed = 0.0
+
+
+    #### Filters ##############################################################
+
+    def make_filter_from_attr(self, attr, value, rules='|', exact=True,
+                              leading_wildcard=True, trailing_wildcard=True):
+        if isinstance(value, (list, tuple)):
+            return self.combine_filters(
+                [self.make_filter_from_attr(attr, v, rules, exact,
+                                            leading_wildcard, trailing_wildcard)
+                 for v in value],
+                rules)
+        value = unicode(value).replace('\\', r'\5c').replace('*', r'\2a') \
+            .replace('(', r'\28').replace(')', r'\29')
+        if not exact:
+            value = u'{0}{1}{2}'.format(
+                '*' if leading_wildcard else '', value,
+                '*' if trailing_wildcard else '')
+        return u'({0}={1})'.format(attr, value)
+
+
+    def make_filter(self, entry_attrs, attrs_list=None, rules='|', exact=True,
+                    leading_wildcard=True, trailing_wildcard=True):
+        return self.combine_filters(
+            [self.make_filter_from_attr(a, v, rules, exact,
+                                        leading_wildcard, trailing_wildcard)
+             for (a, v) in entry_attrs.items()],
+            rules)
+
+
+    def combine_filters(self, filters, rules='|'):
+        filters = [f for f in filters if f]
+        if len(filters) == 1 and rules != '!':
+            return filters[0]
+        return u'({0}{1})'.format(rules, u''.join(filters))
+
+
+    def handle_truncated_result(self, truncated):
+        pass
+
+
+    #### Entries ##############################################################
+
+    def make_entry(self, dn, entry_attrs=None, **kwargs):
+        attrs = dict(entry_attrs or {})
+        attrs.update(kwargs)
+        return FakeEntry(dn, attrs)
+
+
+    def load(self, entry):
+        self.entries[entry.dn] = entry
+        self.children.setdefault(entry.dn[1:], set()).add(entry.dn)
+
+
+    def search(self, base_dn, scope, filter):
+        if scope == self.SCOPE_BASE:
+            dns = [base_dn] if base_dn in self.entries else []
+        elif scope == self.SCOPE_ONELEVEL:
+            dns = self.children.get(base_dn, ())
+        else:
+            dns = [dn for dn in self.entries if dn.endswith(base_dn)]
+        node = parse_filter(filter or u'(objectclass=*)')
+        return [self.entries[dn] for dn in dns if match_filter(node, self.entries[dn])]
+
+
+    @timed
+    def get_entry(self, dn, attrs_list=None):
+        if dn not in self.entries:
+            raise errors.NotFound(reason=u'{0}: entry not found'.format(dn))
+        self.calls['entries_read'] += 1
+        return self.entries[dn].copy(attrs_list)
+
+
+    @timed
+    def get_entries(self, base_dn, scope=SCOPE_SUBTREE, filter=None, attrs_list=None, **kwargs):
+        found = self.search(base_dn, scope, filter)
+        if not found:
+            raise errors.EmptyResult(reason=u'no matching entry found')
+        self.calls['entries_read'] += len(found)
+        return [e.copy(attrs_list) for e in found]
+
+
+    @timed
+    def find_entries(self, filter=None, attrs_list=None, base_dn=None,
+                     scope=SCOPE_SUBTREE, **kwargs):
+        found = self.search(base_dn, scope, filter)
+        if not found:
+            raise errors.EmptyResult(reason=u'no matching entry found')
+        self.calls['entries_read'] += len(found)
+        return ([e.copy(attrs_list) for e in found], False)
+
+
+    @timed
+    def add_entry(self, entry):
+        if entry.dn in self.entries:
+            raise errors.DuplicateEntry()
+        self.load(entry.copy())
+
+
+    @timed
+    def update_entry(self, entry):
+        if entry.dn not in self.entries:
+            raise errors.NotFound(reason=u'{0}: entry not found'.format(entry.dn))
+        stored = self.entries[entry.dn]
+        for (name, value) in entry.items():
+            stored._attrs[name] = list(value)
+
+
+    @timed
+    def delete_entry(self, entry_or_dn):
+        dn = getattr(entry_or_dn, 'dn', entry_or_dn)
+        if dn not in self.entries:
+            raise errors.NotFound(reason=u'{0}: entry not found'.format(dn))
+        del self.entries[dn]
+        self.children.get(dn[1:], set()).discard(dn)
+
+
+
+#### Fixtures #################################################################
+
+
+def make_fixture(size, pools_per_subnet=4, macs_per_host=2):
+
+    # Build a cn=dhcp tree of roughly size entries: 1% of them are /24
+    # subnets, each with pools_per_subnet pools of 20 addresses, and the
+    # rest are dhcpHost entries, macs_per_host per IPA host.
+
+    ldap = FakeLDAP()
+    base = DN(('cn', 'dhcp'), api.env.basedn)
+    ldap.load(FakeEntry(base, dict(
+        objectclass=['top', 'dhcpservice'],
+        cn=['dhcp'],
+        dhcpstatements=['authoritative', 'default-lease-time 43200',
+                        'max-lease-time 86400', 'one-lease-per-client on'],
+        dhcpoption=['domain-name "example.com"'],
+    )))
+
+    subnets = max(size // 100, 1)
+    for i in range(subnets):
+        network = u'10.{0}.{1}.0'.format(i // 256, i % 256)
+        subnet_dn = DN(('cn', network), base)
+        ldap.load(FakeEntry(subnet_dn, dict(
+            objectclass=['top', 'dhcpsubnet', 'dhcpoptions'],
+            cn=[network],
+            dhcpnetmask=['24'],
+            dhcpoption=['subnet-mask 255.255.255.0',
+                        u'broadcast-address 10.{0}.{1}.255'.format(i // 256, i % 256),
+                        u'routers 10.{0}.{1}.1'.format(i // 256, i % 256)],
+        )))
+        for j in range(pools_per_subnet):
+            dhcprange = u'10.{0}.{1}.{2} 10.{0}.{1}.{3}'.format(
+                i // 256, i % 256, 20 + j * 20, 39 + j * 20)
+            ldap.load(FakeEntry(DN(('cn', dhcprange), subnet_dn), dict(
+                objectclass=['top', 'dhcppool'],
+                cn=[dhcprange],
+                dhcprange=[dhcprange],
+                dhcppermitlist=['allow unknown-clients', 'allow known-clients'],
+                dhcpstatements=['default-lease-time 43200', 'max-lease-time 86400'],
+            )))
+
+    hosts = []
+    for i in range((size - subnets * (pools_per_subnet + 1)) // macs_per_host):
+        fqdn = u'host{0}.example.com'.format(i)
+        macs = [make_macaddress(i, k) for k in range(macs_per_host)]
+        for mac in macs:
+            ldap.load(dhcp.dhcphost.make_dhcphost_entry(ldap, fqdn, mac))
+        hosts.append((fqdn, macs))
+
+    ldap.reset_counters()
+    return (ldap, subnets, hosts)
+
+
+def make_macaddress(i, k):
+    value = (i << 8) | k
+    return u':'.join(u'{0:02X}'.format((value >> (8 * b)) & 0xff) for b in range(5, -1, -1))
+
+
+#### Scenarios ################################################################
+
+
+def scenario_dhcphost_add(ldap, subnets, hosts, i):
+    # dhcphost_add as the server runs it: the arguments go through the
+    # command's own normalizer and pattern, execute() checks the MAC is
+    # free, and dhcphost_add_dhcpschema adds the entry it builds.
+    command = api.Command['dhcphost_add']
+    hostname = command.args['hostname'](u'new{0}.example.com'.format(i))
+    macaddress = command.args['macaddress'](make_macaddress(i, 0xfe).lower().replace(':', '-'))
+    dhcp.dhcphost_add.check_macaddress(ldap, macaddress)
+    ldap.add_entry(dhcp.dhcphost.make_dhcphost_entry(ldap, hostname, macaddress))
+
+
+def scenario_dhcphost_import_row(ldap, subnets, hosts, i):
+    dhcp.dhcphost.add_dhcphost_entries(
+        ldap, [(u'import{0}.example.com'.format(i), make_macaddress(i, 0xfc))])
+
+
+def scenario_host_mod_dhcphost(ldap, subnets, hosts, i):
+    (fqdn, macs) = hosts[i % len(hosts)]
+    macs = [macs[0], make_macaddress(i, 0xfd)]
+    hosts[i % len(hosts)] = (fqdn, macs)
+    dhcp.host_mod_dhcphost(
+        api.Command['host_mod'], ldap, DN(('fqdn', fqdn), api.env.basedn), dict(fqdn=[fqdn]),
+        macaddress=tuple(macs))
+
+
+def scenario_dhcppool_add(ldap, subnets, hosts, i):
+    n = i % subnets
+    dhcprange = u'10.{0}.{1}.{2} 10.{0}.{1}.{3}'.format(n // 256, n % 256, 200, 219)
+    subnet_dn = DN(('cn', u'10.{0}.{1}.0'.format(n // 256, n % 256)), 'cn=dhcp', api.env.basedn)
+    dn = DN(('cn', dhcprange), subnet_dn)
+    entry = ldap.make_entry(dn, objectclass=['top', 'dhcppool'], cn=[dhcprange], dhcprange=[dhcprange])
+    api.Command['dhcppool_add'].pre_callback(ldap, dn, entry, [])
+    ldap.add_entry(entry)
+    return lambda: ldap.delete_entry(dn)
+
+
+def scenario_dhcppool_is_valid(ldap, subnets, hosts, i):
+    n = i % subnets
+    dhcp.dhcppool_is_valid.validate(
+        ldap,
+        u'10.{0}.{1}.0'.format(n // 256, n % 256),
+        [u'10.{0}.{1}.{2} 10.{0}.{1}.{3}'.format(n // 256, n % 256, 200, 219)])
+
+
+def scenario_dhcpservice_mod(ldap, subnets, hosts, i):
+    dn = DN(('cn', 'dhcp'), api.env.basedn)
+    entry = ldap.make_entry(dn)
+    api.Command['dhcpservice_mod'].pre_callback(
+        ldap, dn, entry, [], defaultleasetime=40000 + i, domainname=u'example.com')
+    ldap.update_entry(entry)
+
+
+scenarios = (
+    ('dhcphost_add', scenario_dhcphost_add),
+    ('dhcphost_import_row', scenario_dhcphost_import_row),
+    ('host_mod_dhcphost', scenario_host_mod_dhcphost),
+    ('dhcppool_add', scenario_dhcppool_add),
+    ('dhcppool_is_valid', scenario_dhcppool_is_valid),
+    ('dhcpservice_mod', scenario_dhcpservice_mod),
+)
+
+
+#### Runner ###################################################################
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def run_scenario(function, ldap, subnets, hosts, iterations):
+    latencies = []
+    ldap_latencies = []
+    calls = {}
+    for i in range(iterations):
+        destroy_context()
+        ldap.reset_counters()
+        start = time.time()
+        cleanup = function(ldap, subnets, hosts, i)
+        latencies.append((time.time() - start) * 1000)
+        ldap_latencies.append(ldap.elapsed * 1000)
+        for (name, count) in ldap.calls.items():
+            calls[name] = calls.get(name, 0) + count
+        if cleanup is not None:
+            cleanup()
+    return dict(
+        iterations=iterations,
+        latency_ms=dict(
+            mean=sum(latencies) / len(latencies),
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            max=max(latencies),
+        ),
+        ldap_latency_ms=dict(
+            mean=sum(ldap_latencies) / len(ldap_latencies),
+            p50=percentile(ldap_latencies, 50),
+            p95=percentile(ldap_latencies, 95),
+        ),
+        ldap_calls=dict((n, float(c) / iterations) for (n, c) in calls.items()),
+    )
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the DHCP plugin.')
+    parser.add_argument('--sizes', default='10000,100000',
+                        help='comma separated fixture sizes in entries')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--scenario', action='append',
+                        help='only run this scenario (may be repeated)')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args(argv)
+
+    results = dict(started=time.time(), runs=[])
+    for size in [int(s) for s in args.sizes.split(',')]:
+        (ldap, subnets, hosts) = make_fixture(size)
+        run = dict(size=len(ldap.entries), scenarios={})
+        for (name, function) in scenarios:
+            if args.scenario and name not in args.scenario:
+                continue
+            run['scenarios'][name] = run_scenario(
+                function, ldap, subnets, hosts, args.iterations)
+        results['runs'].append(run)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    api.bootstrap(context='benchmark', in_server=True)
+    api.finalize()
+    from ipaserver.plugins import dhcp
+    main(sys.argv[1:])
@@ -19,9 +19,9 @@
 ###############################################################################
 
 SCRIPTPATH=$(dirname $(realpath $0))
-SCHEMATA=( 89dhcp.ldif )
+SCHEMATA=( 89dhcp.ldif 89ipadhcp.ldif )
 UPDATES=( 89dhcp.update )
-IPASERVER_PLUGINS=( dhcp.py )
+IPASERVER_PLUGINS=( dhcp.py dhcputil.py )
 UI_PLUGINS=( dhcp )
 
 ###############################################################################
@@ -81,6 +81,9 @@ echo 'Running ipa-ldap-updater.'
 for schema in ${SCHEMATA[@]}; do
     /usr/sbin/ipa-ldap-updater --schema-file=${SCHEMA_DEST}/${schema}
 done
+for update in ${UPDATES[@]}; do
+    /usr/sbin/ipa-ldap-updater ${UPDATE_DEST}/${update}
+done
 
 ###############################################################################
 
@@ -20,8 +20,18 @@
 #### Imports ##################################################################
 
 
+import base64
+import bisect
+import collections
+import csv
+import json
+import logging
+import re
+import threading
+import time
+
 from ipalib import _, ngettext
-from ipalib import api, errors, output, Command
+from ipalib import api, errors, messages, output, Command
 from ipalib.output import Output, Entry, ListOfEntries
 from .baseldap import (
     LDAPObject,
@@ -29,11 +39,23 @@ from .baseldap import (
     LDAPUpdate,
     LDAPSearch,
     LDAPDelete,
-    LDAPRetrieve)
+    LDAPRetrieve,
+    entry_to_dict)
+from .dhcputil import (
+    SubnetTrie,
+    PoolRangeIndex,
+    iter_text_lines,
+    iter_dhcpd_leases,
+    normalize_macaddress,
+    get_kea_subnet_ids)
 from ipalib.parameters import *
 from ipalib.plugable import Registry
+from ipalib.request import context
 from ipapython.dn import DN
 from ipapython.dnsutil import DNSName
+import ldap as _ldap
+from ldap.controls.sss import SSSRequestControl
+from ldap.filter import escape_filter_chars
 from netaddr import *
 
 
@@ -43,6 +65,497 @@ from netaddr import *
 container_dn = DN(('cn', 'dhcp'))
 register = Registry()
 
+# Export caches (see get_export_cache) of this server process, one per
+# bind DN, least recently used first.
+export_caches = collections.OrderedDict()
+export_caches_lock = threading.Lock()
+export_caches_limit = 16
+
+index_dn = DN(
+    ('cn', 'index'), ('cn', 'userRoot'), ('cn', 'ldbm database'),
+    ('cn', 'plugins'), ('cn', 'config')
+)
+
+# The searches dhcpd and this plugin issue against cn=dhcp (and, to
+# resolve fixed addresses, cn=dns), with the (attribute, index type) pairs
+# each of them needs to avoid a full scan.
+dhcp_searches = (
+    (u'dhcpd: host lookup by hardware address',
+        (('dhcphwaddress', 'eq'), ('objectclass', 'eq'))),
+    (u'dhcpd: service lookup by server DN',
+        (('dhcpprimarydn', 'eq'), ('dhcpsecondarydn', 'eq'))),
+    (u'dhcpd: server lookup by hostname',
+        (('cn', 'eq'), ('objectclass', 'eq'))),
+    (u'dhcp plugin: subnets, pools, hosts and servers by object class',
+        (('objectclass', 'eq'),)),
+    (u'dhcp plugin: pages of subnets, pools and hosts by cn',
+        (('cn', 'eq'), ('objectclass', 'eq'))),
+    (u'dhcp plugin: DHCP hosts of an IPA host',
+        (('cn', 'sub'), ('objectclass', 'eq'))),
+    (u'dhcp plugin: DHCP hosts by hardware address',
+        (('dhcphwaddress', 'eq'), ('objectclass', 'eq'))),
+    (u'dhcp plugin: fixed addresses in a subnet',
+        (('dhcpstatements', 'eq'), ('dhcpstatements', 'sub'), ('objectclass', 'eq'))),
+    (u'dhcp plugin: DHCP entries and DNS records changed since the last export',
+        (('entryusn', 'eq'), ('objectclass', 'eq'))),
+    (u'dhcp plugin: DNS records of fixed-address names',
+        (('idnsname', 'eq'), ('arecord', 'pres'))),
+    (u'dhcp plugin: DNS records with an address in a subnet',
+        (('arecord', 'eq'), ('arecord', 'sub'))),
+)
+
+macaddress_pattern = '^([a-fA-F0-9]{2}[:|\-]?){5}[a-fA-F0-9]{2}$'
+macaddress_errmsg = ('Must be of the form HH:HH:HH:HH:HH:HH, where '
+                     'each H is a hexadecimal character.')
+
+logger = logging.getLogger(__name__)
+
+# Terms per OR filter when many values are looked up at once, to stay well
+# within the server's filter and size limits.
+ldap_filter_batch = 500
+
+
+#### instrumentation ##########################################################
+
+
+# Running counters per (command, phase), shared by the threads of this
+# server process.
+command_stats = {}
+command_stats_lock = threading.Lock()
+command_stats_samples = 1000
+
+ldap_read_methods = ('get_entry', 'get_entries', 'find_entries', 'find_entry_by_attr')
+ldap_write_methods = ('add_entry', 'update_entry', 'delete_entry', 'move_entry', 'modify_s')
+
+
+class LDAPCallCounter(object):
+
+    # Wraps an ldap2 backend for the duration of one callback, counting the
+    # reads, writes and entries that go through it. Everything else is
+    # passed straight through.
+
+    def __init__(self, ldap):
+        self._ldap = ldap
+        self.reads = 0
+        self.writes = 0
+        self.entries = 0
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._ldap, name)
+        if name not in ldap_read_methods and name not in ldap_write_methods:
+            return attr
+
+        def counted(*args, **kwargs):
+            if name in ldap_read_methods:
+                self.reads += 1
+            else:
+                self.writes += 1
+            result = attr(*args, **kwargs)
+            if name == 'find_entries':
+                self.entries += len(result[0])
+            elif isinstance(result, list):
+                self.entries += len(result)
+            else:
+                self.entries += 1
+            return result
+
+        return counted
+
+
+class RequestLDAP(object):
+
+    # Stands in for an LDAPObject's backend, so that the LDAP calls the
+    # inherited baseldap execute() methods make go through the counting
+    # wrapper of the command running in this thread, if any.
+
+    def __init__(self, ldap):
+        self._ldap = ldap
+
+
+    def __getattr__(self, name):
+        return getattr(getattr(context, 'dhcp_ldap', None) or self._ldap, name)
+
+
+def ldap_backend(api):
+
+    # The backend execute() methods should use: the counting wrapper the
+    # instrumentation installed for the running command, if any.
+
+    return getattr(context, 'dhcp_ldap', None) or api.Backend.ldap2
+
+
+def record_command_stats(name, phase, elapsed, counter):
+    with command_stats_lock:
+        stats = command_stats.get((name, phase))
+        if stats is None:
+            stats = command_stats[(name, phase)] = dict(
+                calls=0, reads=0, writes=0, entries=0, elapsed=0.0,
+                samples=collections.deque(maxlen=command_stats_samples)
+            )
+        stats['calls'] += 1
+        stats['reads'] += counter.reads
+        stats['writes'] += counter.writes
+        stats['entries'] += counter.entries
+        stats['elapsed'] += elapsed
+        stats['samples'].append(elapsed)
+    logger.debug(
+        'dhcp: %s %s took %.1f ms, %d LDAP reads, %d writes, %d entries',
+        name, phase, elapsed * 1000, counter.reads, counter.writes, counter.entries
+    )
+
+
+def instrumented(name, phase, function):
+
+    # Callbacks get the counting wrapper in place of their ldap argument;
+    # execute() finds it on the request context through ldap_backend.
+
+    def wrapper(self, *args, **kwargs):
+        # Commands are recorded under their own name, which for methods
+        # inherited from a shared base class is only known at call time.
+        label = name or self.name
+        start = time.time()
+        if phase == 'execute':
+            obj = getattr(self, 'obj', None)
+            backend = getattr(obj, 'backend', None)
+            if backend is not None and not isinstance(backend, RequestLDAP):
+                # Plugins are read-only once the API is finalized.
+                object.__setattr__(obj, 'backend', RequestLDAP(backend))
+            counter = LDAPCallCounter(self.api.Backend.ldap2)
+            previous = getattr(context, 'dhcp_ldap', None)
+            context.dhcp_ldap = counter
+            try:
+                return function(self, *args, **kwargs)
+            finally:
+                context.dhcp_ldap = previous
+                record_command_stats(label, phase, time.time() - start, counter)
+        counter = LDAPCallCounter(args[0])
+        try:
+            return function(self, counter, *args[1:], **kwargs)
+        finally:
+            record_command_stats(label, phase, time.time() - start, counter)
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_commands(namespace):
+
+    # Callbacks are wrapped where this module defines them. execute() is
+    # wrapped on every command class, including the ones that inherit it
+    # from LDAPCreate, LDAPUpdate and the other baseldap classes, unless it
+    # comes from a class of this module that was wrapped already.
+
+    for obj in list(namespace.values()):
+        if not isinstance(obj, type) or not issubclass(obj, Command):
+            continue
+        if obj.__module__ != __name__:
+            continue
+        for phase in ('pre_callback', 'post_callback', 'execute'):
+            function = obj.__dict__.get(phase)
+            if function is None and phase == 'execute':
+                function = getattr(getattr(obj, phase, None), '__func__', None)
+            if function is None or isinstance(function, staticmethod):
+                continue
+            if getattr(function, 'instrumented', False):
+                continue
+            setattr(obj, phase, instrumented(None, phase.replace('_callback', ''), function))
+
+
+#### dhcp parameters ##########################################################
+
+
+class DHCPParameterList(object):
+
+    # One multi-valued dhcpStatements, dhcpOption or dhcpPermitList
+    # attribute, parsed once into an index from keyword to position. For
+    # statements and options the keyword is the first word ("routers",
+    # "default-lease-time"); for permit lists it is the last one
+    # ("known-clients"). Values keep their order when serialized back.
+
+    def __init__(self, values, permit=False):
+        self.values = list(values)
+        self.permit = permit
+        self.index = {}
+        for (i, value) in enumerate(self.values):
+            self.index.setdefault(self.keyword(value), i)
+
+
+    def keyword(self, value):
+        if self.permit:
+            return value.rsplit(' ', 1)[-1]
+        return value.split(' ', 1)[0]
+
+
+    def get(self, keyword):
+        i = self.index.get(keyword)
+        if i is None:
+            return None
+        if self.permit:
+            return self.values[i].rsplit(' ', 1)[0]
+        parts = self.values[i].split(' ', 1)
+        return parts[1] if len(parts) > 1 else u''
+
+
+    def set(self, keyword, value):
+        if self.permit:
+            item = u'{0} {1}'.format(value, keyword)
+        else:
+            item = u'{0} {1}'.format(keyword, value)
+        i = self.index.get(keyword)
+        if i is None:
+            self.index[keyword] = len(self.values)
+            self.values.append(item)
+        else:
+            self.values[i] = item
+
+
+    def serialize(self):
+        return list(self.values)
+
+
+def decode_quoted(value):
+    return value.replace('"', '')
+
+
+def encode_quoted(value):
+    return u'"{0}"'.format(value)
+
+
+def decode_list(value):
+    return value.split(', ')
+
+
+def encode_list(values):
+    return u', '.join(values)
+
+
+def decode_quoted_list(value):
+    return value.replace('"', '').split(', ')
+
+
+def encode_quoted_list(values):
+    return u', '.join(u'"{0}"'.format(v) for v in values)
+
+
+def decode_permit(value):
+    return value == 'allow'
+
+
+def encode_permit(value):
+    return u'allow' if value else u'deny'
+
+
+# Virtual attributes stored inside the multi-valued attributes above, as
+# (virtual attribute, LDAP attribute, keyword, decode, encode).
+lease_time_params = (
+    ('defaultleasetime', 'dhcpstatements', 'default-lease-time', unicode, unicode),
+    ('maxleasetime', 'dhcpstatements', 'max-lease-time', unicode, unicode),
+)
+
+domain_params = (
+    ('domainname', 'dhcpoption', 'domain-name', decode_quoted, encode_quoted),
+    ('domainnameservers', 'dhcpoption', 'domain-name-servers', decode_list, encode_list),
+    ('domainsearch', 'dhcpoption', 'domain-search', decode_quoted_list, encode_quoted_list),
+)
+
+router_params = (
+    ('router', 'dhcpoption', 'routers', unicode, unicode),
+)
+
+permit_params = (
+    ('permitknownclients', 'dhcppermitlist', 'known-clients', decode_permit, encode_permit),
+    ('permitunknownclients', 'dhcppermitlist', 'unknown-clients', decode_permit, encode_permit),
+)
+
+
+def parse_parameter_lists(entry_attrs, attrs):
+    return dict(
+        (attr, DHCPParameterList(entry_attrs.get(attr, []), attr == 'dhcppermitlist'))
+        for attr in attrs
+    )
+
+
+def extract_virtual_params(entry_attrs, virtual_params):
+
+    # Parse each backing attribute once and serve every virtual attribute
+    # from its index.
+
+    parsed = parse_parameter_lists(entry_attrs, set(v[1] for v in virtual_params))
+    for (name, attr, keyword, decode, encode) in virtual_params:
+        value = parsed[attr].get(keyword)
+        if value is not None:
+            entry_attrs[name] = decode(value)
+    return entry_attrs
+
+
+def apply_virtual_params(ldap, dn, entry_attrs, virtual_params, options):
+
+    # Write the virtual attributes given in options back into their backing
+    # attributes. The stored entry is only read if one of those attributes
+    # wasn't passed explicitly, and then only once.
+
+    attrs = set(v[1] for v in virtual_params if v[0] in options)
+    if not attrs:
+        return entry_attrs
+
+    missing = [a for a in attrs if a not in entry_attrs]
+    if missing:
+        entry = ldap.get_entry(dn, missing)
+    else:
+        entry = {}
+
+    parsed = dict(
+        (attr, DHCPParameterList(
+            to_list(entry_attrs[attr]) if attr in entry_attrs else entry.get(attr, []),
+            attr == 'dhcppermitlist'))
+        for attr in attrs
+    )
+    for (name, attr, keyword, decode, encode) in virtual_params:
+        if name in options:
+            parsed[attr].set(keyword, encode(options[name]))
+    for attr in attrs:
+        entry_attrs[attr] = parsed[attr].serialize()
+    return entry_attrs
+
+
+#### paging ###################################################################
+
+
+def find_sorted_values(ldap, base_dn, scope, filter, attr, limit):
+
+    # The values of attr from the first limit entries matching filter, in
+    # the server's ordering for attr. The server sorts (server side sort
+    # control) and stops after limit entries, so a page costs one search
+    # returning one page worth of entries however big the tree is. An entry
+    # with several values sorts, and is keyed here, by its lowest one.
+
+    values = []
+    control = SSSRequestControl(criticality=True, ordering_rules=[attr])
+    with ldap.error_handler():
+        msgid = ldap.conn.search_ext(
+            str(base_dn), scope, filter.encode('utf-8'), [attr],
+            serverctrls=[control], sizelimit=limit)
+        try:
+            while True:
+                (rtype, rdata) = ldap.conn.result(msgid, 0)
+                if rtype == _ldap.RES_SEARCH_RESULT:
+                    break
+                for (dn, attrs) in rdata:
+                    if dn is None:
+                        continue
+                    found = [
+                        value.decode('utf-8')
+                        for (name, v) in attrs.items() if name.lower() == attr
+                        for value in v
+                    ]
+                    if found:
+                        values.append(min(found, key=lambda value: value.lower()))
+        except _ldap.SIZELIMIT_EXCEEDED:
+            pass
+    return values
+
+
+def encode_cursor(cn):
+    return unicode(base64.urlsafe_b64encode(cn.encode('utf-8')))
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (TypeError, UnicodeError):
+        raise errors.ValidationError(name='cursor', error=_('Invalid cursor.'))
+
+
+def find_page(ldap, base_dn, scope, filter, pagesize, cursor=None):
+
+    # Keyset paging on cn: have the server return the pagesize + 1 lowest
+    # cns past the cursor, then hand back the page and the cursor for the
+    # next one. Nothing has to survive between requests but the cursor, and
+    # each page reads one page worth of entries whatever the size of the
+    # tree.
+
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        filter = ldap.combine_filters([
+            filter,
+            u'(cn>=%s)' % escape_filter_chars(after),
+            ldap.make_filter_from_attr('cn', after, ldap.MATCH_NONE)
+        ], ldap.MATCH_ALL)
+
+    cns = find_sorted_values(ldap, base_dn, scope, filter, 'cn', pagesize + 1)
+    page = cns[:pagesize]
+    if len(cns) > pagesize:
+        return (page, encode_cursor(page[-1]))
+    return (page, None)
+
+
+class DHCPPagedSearch(LDAPSearch):
+
+    # Search commands over containers that can grow to tens of thousands of
+    # entries. Passing --pagesize returns at most that many entries, sorted
+    # by cn, along with a cursor to pass back with --cursor for the next
+    # page; the last page comes back without one.
+
+    takes_options = LDAPSearch.takes_options + (
+        Int(
+            'pagesize?',
+            cli_name='pagesize',
+            label=_('Page size'),
+            doc=_('Return at most this many entries, along with a cursor for the next page.'),
+            minvalue=1,
+            maxvalue=ldap_filter_batch
+        ),
+        Str(
+            'cursor?',
+            cli_name='cursor',
+            label=_('Cursor'),
+            doc=_('Continue from the cursor returned with the previous page.')
+        ),
+    )
+
+    has_output = LDAPSearch.has_output + (
+        Output('cursor', (unicode, type(None)), _('Cursor for the next page')),
+    )
+
+    default_pagesize = 100
+
+
+    def apply_page(self, ldap, filter, base_dn, scope, options):
+        if options.get('pagesize') is None and options.get('cursor') is None:
+            return (filter, base_dn, scope)
+
+        pagesize = options.get('pagesize') or self.default_pagesize
+        (cns, context.dhcp_cursor) = find_page(
+            ldap, base_dn, scope, filter, pagesize, options.get('cursor'))
+        if cns:
+            cn_filter = ldap.make_filter_from_attr('cn', cns, ldap.MATCH_ANY)
+        else:
+            cn_filter = '(!(objectclass=*))'
+        filter = ldap.combine_filters([filter, cn_filter], ldap.MATCH_ALL)
+        return (filter, base_dn, scope)
+
+
+    def pre_callback(self, ldap, filter, attrs_list, base_dn, scope, *args, **options):
+        assert isinstance(base_dn, DN)
+        return self.apply_page(ldap, filter, base_dn, scope, options)
+
+
+    def execute(self, *args, **options):
+        # The page is cut by apply_page, so the configured search size limit
+        # must not truncate it again.
+        if options.get('pagesize') is not None or options.get('cursor') is not None:
+            options['sizelimit'] = options.get('pagesize') or self.default_pagesize
+        context.dhcp_cursor = None
+        try:
+            ret = super(DHCPPagedSearch, self).execute(*args, **options)
+            ret['cursor'] = context.dhcp_cursor
+        finally:
+            context.dhcp_cursor = None
+        return ret
+
 
 #### dhcpservice ##############################################################
 
@@ -68,7 +581,7 @@ class dhcpservice(LDAPObject):
                 'dhcpprimarydn', 'dhcpsecondarydn',
                 'dhcpnetmask',
                 'dhcprange', 'dhcppermitlist',
-                'dhcpservicedn',
+                'dhcpservicedn', 'dhcpsubnetdn',
                 'dhcpHWAddress',
                 'dhcpstatements', 'dhcpoption', 'dhcpcomments'
             },
@@ -158,7 +671,9 @@ class dhcpservice(LDAPObject):
 
 
     def get_dhcpservice(self, ldap):
-        entry = ldap.get_entry(self.get_dn(), None)
+        entry = dhcpservice.get_cached_entry(ldap)
+        if entry is None:
+            raise errors.NotFound(reason=_('DHCP is not configured'))
         return entry
 
 
@@ -168,41 +683,79 @@ class dhcpservice(LDAPObject):
         return DN(container_dn, api.env.basedn)
 
 
+    @staticmethod
+    def get_cached_entry(ldap):
+
+        # The dhcpService entry is read at most once per request (a batch
+        # call being a single request) and kept on the request context,
+        # which IPA clears when the request ends. Anything that writes the
+        # entry must call invalidate_cached_entry. Returns None if DHCP is
+        # not configured.
+
+        entry = getattr(context, 'dhcpservice_entry', None)
+        if entry is None:
+            try:
+                entry = ldap.get_entry(DN(container_dn, api.env.basedn))
+            except errors.NotFound:
+                entry = False
+            context.dhcpservice_entry = entry
+        return entry or None
+
+
+    @staticmethod
+    def invalidate_cached_entry():
+        context.dhcpservice_entry = None
+
+
     @staticmethod
     def dhcpservice_exists(ldap):
+        return dhcpservice.get_cached_entry(ldap) is not None
+
+
+    @staticmethod
+    def modify_secondary_dns(ldap, add=(), delete=()):
+
+        # Change dhcpSecondaryDN with add-value and delete-value operations
+        # instead of rewriting the whole attribute, so that concurrent
+        # server changes can't overwrite each other.
+
+        dn = DN(container_dn, api.env.basedn)
+        modlist = (
+            [(_ldap.MOD_ADD, 'dhcpsecondarydn', [str(v)]) for v in add] +
+            [(_ldap.MOD_DELETE, 'dhcpsecondarydn', [str(v)]) for v in delete]
+        )
+        if not modlist:
+            return
+
+        def modify(mods):
+            # modify_s is raw python-ldap, so map its errors to IPA ones,
+            # except for a value someone else already added or removed,
+            # which is reported as False.
+            with ldap.error_handler():
+                try:
+                    ldap.modify_s(dn, mods)
+                except (_ldap.TYPE_OR_VALUE_EXISTS, _ldap.NO_SUCH_ATTRIBUTE):
+                    return False
+            return True
+
         try:
-            ldap.get_entry(DN(container_dn, api.env.basedn), [])
+            if not modify(modlist) and len(modlist) > 1:
+                # One value failed the whole modify; apply the rest one
+                # by one.
+                for mod in modlist:
+                    modify([mod])
         except errors.NotFound:
-            return False
-        return True
+            raise errors.NotFound(reason=_('DHCP is not configured'))
+        finally:
+            dhcpservice.invalidate_cached_entry()
+
+
+    virtual_params = lease_time_params + domain_params
 
 
     @staticmethod
     def extract_virtual_params(ldap, dn, entry_attrs, keys, options):
-        dhcpStatements = entry_attrs.get('dhcpstatements', [])
-
-        for statement in dhcpStatements:
-            if statement.startswith('default-lease-time '):
-                (s, v) = statement.split(' ', 1)
-                entry_attrs['defaultleasetime'] = v
-            if statement.startswith('max-lease-time '):
-                (s, v) = statement.split(' ', 1)
-                entry_attrs['maxleasetime'] = v
-
-        dhcpOptions = entry_attrs.get('dhcpoption', [])
-
-        for option in dhcpOptions:
-            if option.startswith('domain-name '):
-                (o, v) = option.split(' ', 1)
-                entry_attrs['domainname'] = v.replace('"', '')
-            if option.startswith('domain-name-servers '):
-                (o, v) = option.split(' ', 1)
-                entry_attrs['domainnameservers'] = v.split(', ')
-            if option.startswith('domain-search '):
-                (o, v) = option.split(' ', 1)
-                entry_attrs['domainsearch'] = v.replace('"', '').split(', ')
-
-        return entry_attrs
+        return extract_virtual_params(entry_attrs, dhcpservice.virtual_params)
 
 
 @register()
@@ -224,77 +777,8 @@ class dhcpservice_mod(LDAPUpdate):
 
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         assert isinstance(dn, DN)
-
-        if 'dhcpstatements' in entry_attrs:
-            dhcpStatements = entry_attrs.get('dhcpstatements', [])
-        else:
-            entry = ldap.get_entry(dn)
-            dhcpStatements = entry.get('dhcpstatements', [])
-
-        if 'defaultleasetime' in options:
-            statement = 'default-lease-time {0}'.format(options['defaultleasetime'])
-            foundStatement = False
-            for i, s in enumerate(dhcpStatements):
-                if s.startswith('default-lease-time '):
-                    foundStatement = True
-                    dhcpStatements[i] = statement
-                    break
-            if not foundStatement:
-                dhcpStatements.append(statement)
-
-        if 'maxleasetime' in options:
-            statement = 'max-lease-time {0}'.format(options['maxleasetime'])
-            foundStatement = False
-            for i, s in enumerate(dhcpStatements):
-                if s.startswith('max-lease-time '):
-                    foundStatement = True
-                    dhcpStatements[i] = statement
-                    break
-            if not foundStatement:
-                dhcpStatements.append(statement)
-
-        if 'dhcpoption' in entry_attrs:
-            dhcpOptions = entry_attrs.get('dhcpoption', [])
-        else:
-            entry = ldap.get_entry(dn)
-            dhcpOptions = entry.get('dhcpoption', [])
-
-        if 'domainname' in options:
-            option = 'domain-name "{0}"'.format(options['domainname'])
-            foundOption = False
-            for i, s in enumerate(dhcpOptions):
-                if s.startswith('domain-name '):
-                    foundOption = True
-                    dhcpOptions[i] = option
-                    break
-            if not foundOption:
-                dhcpOptions.append(option)
-
-        if 'domainnameservers' in options:
-            option = 'domain-name-servers ' + ', '.join(options['domainnameservers'])
-            foundOption = False
-            for i, s in enumerate(dhcpOptions):
-                if s.startswith('domain-name-servers '):
-                    foundOption = True
-                    dhcpOptions[i] = option
-                    break
-            if not foundOption:
-                dhcpOptions.append(option)
-
-        if 'domainsearch' in options:
-            option = 'domain-search ' + ', '.join('"' + s + '"' for s in options['domainsearch'])
-            foundOption = False
-            for i, s in enumerate(dhcpOptions):
-                if s.startswith('domain-search '):
-                    foundOption = True
-                    dhcpOptions[i] = option
-                    break
-            if not foundOption:
-                dhcpOptions.append(option)
-
-        entry_attrs['dhcpstatements'] = dhcpStatements
-        entry_attrs['dhcpoption'] = dhcpOptions
-
+        dhcpservice.invalidate_cached_entry()
+        apply_virtual_params(ldap, dn, entry_attrs, dhcpservice.virtual_params, options)
         return dn
 
 
@@ -386,17 +870,24 @@ class dhcpsubnet(LDAPObject):
     )
 
 
+    virtual_params = router_params
+
+
     @staticmethod
     def extract_virtual_params(ldap, dn, entry_attrs, keys, options):
+        return extract_virtual_params(entry_attrs, dhcpsubnet.virtual_params)
 
-        dhcpOptions = entry_attrs.get('dhcpoption', [])
 
-        for option in dhcpOptions:
-            if option.startswith('routers '):
-                (o, v) = option.split(' ', 1)
-                entry_attrs['router'] = v
-
-        return entry_attrs
+def get_subnet_trie(ldap):
+    trie = SubnetTrie()
+    entries = get_dhcp_entries(ldap, '(objectclass=dhcpsubnet)', ['cn', 'dhcpnetmask'])
+    for entry in entries:
+        try:
+            subnet = IPNetwork(u'{0}/{1}'.format(entry['cn'][0], int(entry['dhcpnetmask'][0])))
+        except (KeyError, ValueError, AddrFormatError):
+            continue
+        trie.insert(subnet.first, subnet.prefixlen, entry['cn'][0])
+    return trie
 
 
 @register()
@@ -408,6 +899,15 @@ class dhcpsubnet_add(LDAPCreate):
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         assert isinstance(dn, DN)
         ip = IPNetwork('{0}/{1}'.format(keys[-1], options['dhcpnetmask']))
+
+        overlapping = get_subnet_trie(ldap).find_overlapping(ip.first, ip.prefixlen)
+        if overlapping:
+            raise errors.ValidationError(
+                name='cn',
+                error=_('%(subnet)s overlaps existing subnet %(other)s') % dict(
+                    subnet=ip.cidr, other=overlapping[0])
+            )
+
         dhcpOptions = []
         dhcpOptions.append('subnet-mask {0}'.format(ip.netmask))
         dhcpOptions.append('broadcast-address {0}'.format(ip.broadcast))
@@ -420,10 +920,19 @@ class dhcpsubnet_add(LDAPCreate):
         return dn
 
 
+def resolve_offset(network, offset):
+    if offset < 0:
+        return network.last + offset + 1
+    return network.first + offset
+
+
 @register()
 class dhcpsubnet_add_cidr(Command):
-    has_output = output.standard_entry
-    __doc__ = _('Create a new DHCP subnet by network address in CIDR format.')
+    has_output = output.standard_entry + (
+        Output('subnets', (list, tuple), _('Created subnets')),
+        Output('count', int, _('Number of subnets created')),
+    )
+    __doc__ = _('Create a new DHCP subnet by network address in CIDR format, or carve a supernet into many subnets.')
     msg_summary = _('Created DHCP subnet "%(value)s"')
 
     takes_args = (
@@ -435,27 +944,234 @@ class dhcpsubnet_add_cidr(Command):
         )
     )
 
+    takes_options = (
+        Int(
+            'prefixlen?',
+            cli_name='prefixlen',
+            label=_('Subnet Prefix Length'),
+            doc=_('Split the network into subnets of this prefix length.'),
+            minvalue=0,
+            maxvalue=32
+        ),
+        Int(
+            'router?',
+            cli_name='router',
+            label=_('Router Offset'),
+            doc=_('Position of the router in each subnet, e.g. 1 for the first address; negative values count back from the broadcast address.')
+        ),
+        Str(
+            'pool?',
+            cli_name='pool',
+            label=_('Pool Template'),
+            doc=_('Pool range in each subnet as two offsets, e.g. "100 199"; negative values count back from the broadcast address.')
+        ),
+        Str(
+            'dhcpcomments?',
+            cli_name='dhcpcomments',
+            label=_('Comments'),
+            doc=_('DHCP comments.')
+        ),
+    )
+
+    max_subnets = 65536
+
     def execute(self, *args, **kw):
-        ip = IPNetwork(args[-1])
-        cn = unicode(ip.network)
-        dhcpnetmask = ip.prefixlen
-        result = api.Command['dhcpsubnet_add'](cn, dhcpnetmask=dhcpnetmask)
-        return dict(result=result['result'], value=cn)
+
+        # Work out every subnet and pool in memory first, checking overlaps
+        # against a trie of the existing subnets, so that nothing is written
+        # unless the whole carve-up is valid. Then add all the entries
+        # straight through the LDAP backend, deleting the ones already added
+        # if a later add fails, as dhcp_apply does.
+
+        ldap = ldap_backend(self.api)
+        try:
+            supernet = IPNetwork(args[-1])
+        except (ValueError, AddrFormatError) as e:
+            raise errors.ValidationError(name='networkaddr', error=unicode(e))
+
+        prefixlen = kw.get('prefixlen')
+        if prefixlen is None:
+            prefixlen = supernet.prefixlen
+        if prefixlen < supernet.prefixlen:
+            raise errors.ValidationError(
+                name='prefixlen',
+                error=_('must not be shorter than the prefix of %(network)s') % dict(network=supernet.cidr))
+        if 2 ** (prefixlen - supernet.prefixlen) > self.max_subnets:
+            raise errors.ValidationError(
+                name='prefixlen',
+                error=_('would create more than %(max)d subnets') % dict(max=self.max_subnets))
+
+        pool = None
+        if kw.get('pool'):
+            try:
+                pool = [int(o) for o in kw['pool'].split()]
+            except ValueError:
+                pool = []
+            if len(pool) != 2:
+                raise errors.ValidationError(name='pool', error=_('must be two offsets, e.g. "100 199"'))
+
+        trie = get_subnet_trie(ldap)
+        service = self.api.Object['dhcpservice'].get_dhcpservice(ldap)
+        config = DHCPParameterList(service.get('dhcpstatements', []))
+        lease_statements = []
+        for (n, a, keyword, d, e) in lease_time_params:
+            value = config.get(keyword)
+            if value is not None:
+                lease_statements.append(u'{0} {1}'.format(keyword, value))
+
+        entries = []
+        subnets = []
+        for network in supernet.subnet(prefixlen):
+            overlapping = trie.find_overlapping(network.first, network.prefixlen)
+            if overlapping:
+                raise errors.ValidationError(
+                    name='networkaddr',
+                    error=_('%(subnet)s overlaps existing subnet %(other)s') % dict(
+                        subnet=network.cidr, other=overlapping[0])
+                )
+
+            cn = unicode(network.network)
+            dn = DN(('cn', cn), container_dn, api.env.basedn)
+            dhcpOptions = [
+                u'subnet-mask {0}'.format(network.netmask),
+                u'broadcast-address {0}'.format(network.broadcast),
+            ]
+            if kw.get('router') is not None:
+                router = resolve_offset(network, kw['router'])
+                if router < network.first or router > network.last:
+                    raise errors.ValidationError(name='router', error=_('is outside %(subnet)s') % dict(subnet=network.cidr))
+                dhcpOptions.append(u'routers {0}'.format(IPAddress(router)))
+
+            subnet = ldap.make_entry(
+                dn,
+                objectclass=['top'] + self.api.Object['dhcpsubnet'].object_class,
+                cn=[cn],
+                dhcpnetmask=[unicode(network.prefixlen)],
+                dhcpoption=dhcpOptions
+            )
+            if kw.get('dhcpcomments'):
+                subnet['dhcpcomments'] = [kw['dhcpcomments']]
+            entries.append(subnet)
+            subnets.append(subnet)
+
+            if pool is not None:
+                (start, end) = [resolve_offset(network, o) for o in pool]
+                if start > end or start < network.first or end > network.last:
+                    raise errors.ValidationError(name='pool', error=_('is outside %(subnet)s') % dict(subnet=network.cidr))
+                dhcprange = u'{0} {1}'.format(IPAddress(start), IPAddress(end))
+                entries.append(ldap.make_entry(
+                    DN(('cn', dhcprange), dn),
+                    objectclass=['top'] + self.api.Object['dhcppool'].object_class,
+                    cn=[dhcprange],
+                    dhcprange=[dhcprange],
+                    dhcppermitlist=[u'allow unknown-clients', u'allow known-clients'],
+                    dhcpstatements=list(lease_statements)
+                ))
+
+        undo = []
+        try:
+            for entry in entries:
+                ldap.add_entry(entry)
+                undo.append((u'delete', entry.dn, None))
+        except errors.ExecutionError:
+            rollback_changeset(ldap, undo)
+            raise
+
+        result = dict(subnets[0])
+        result['dn'] = subnets[0].dn
+        ret = dict(
+            result=result,
+            value=subnets[0]['cn'][0],
+            subnets=[e['cn'][0] for e in subnets],
+            count=len(subnets)
+        )
+        if len(subnets) > 1:
+            ret['summary'] = unicode(_('Created %(count)d DHCP subnets in "%(network)s"') % dict(
+                count=len(subnets), network=supernet.cidr))
+        return ret
 
 
 @register()
-class dhcpsubnet_find(LDAPSearch):
+class dhcpsubnet_find(DHCPPagedSearch):
     __doc__ = _('Search for a DHCP subnet.')
     msg_summary = ngettext(
         '%(count)d DHCP subnet matched',
         '%(count)d DHCP subnets matched', 0
     )
 
+    takes_options = DHCPPagedSearch.takes_options + (
+        Str(
+            'contains?',
+            cli_name='contains',
+            label=_('Contains'),
+            doc=_('Only return subnets containing this IP address.')
+        ),
+        Str(
+            'overlaps?',
+            cli_name='overlaps',
+            label=_('Overlaps'),
+            doc=_('Only return subnets overlapping this network (CIDR notation).')
+        ),
+    )
+
+
+    def pre_callback(self, ldap, filter, attrs_list, base_dn, scope, *args, **options):
+        assert isinstance(base_dn, DN)
+
+        if not options.get('contains') and not options.get('overlaps'):
+            return self.apply_page(ldap, filter, base_dn, scope, options)
+
+        # Answer the address queries from a prefix trie built with one
+        # search, then narrow the regular search down to the subnets found.
+
+        trie = get_subnet_trie(ldap)
+        cns = None
+        if options.get('contains'):
+            try:
+                ip = IPAddress(options['contains'])
+            except (ValueError, AddrFormatError) as e:
+                raise errors.ValidationError(name='contains', error=unicode(e))
+            cns = set(trie.find_containing(ip.value))
+        if options.get('overlaps'):
+            try:
+                network = IPNetwork(options['overlaps'])
+            except (ValueError, AddrFormatError) as e:
+                raise errors.ValidationError(name='overlaps', error=unicode(e))
+            found = set(trie.find_overlapping(network.first, network.prefixlen))
+            cns = found if cns is None else cns & found
+
+        if cns:
+            cn_filter = ldap.make_filter_from_attr('cn', list(cns), ldap.MATCH_ANY)
+        else:
+            cn_filter = '(!(objectclass=*))'
+        filter = ldap.combine_filters([filter, cn_filter], ldap.MATCH_ALL)
+        return self.apply_page(ldap, filter, base_dn, scope, options)
+
+
+    def post_callback(self, ldap, entries, truncated, *args, **options):
+        for entry in entries:
+            dhcpsubnet.extract_virtual_params(ldap, entry.dn, entry, args, options)
+        return truncated
+
 
 @register()
 class dhcpsubnet_show(LDAPRetrieve):
     __doc__ = _('Display a DHCP subnet.')
 
+    takes_options = LDAPRetrieve.takes_options + (
+        Flag(
+            'all_pools',
+            cli_name='all-pools',
+            label=_('All Pools'),
+            doc=_('Also return every pool of the subnet and its utilization.')
+        ),
+    )
+
+    has_output = output.standard_entry + (
+        Output('pools', (list, tuple, type(None)), _('Pools of the subnet')),
+        Output('usage', (dict, type(None)), _('Utilization of the subnet')),
+    )
+
 
     def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
         assert isinstance(dn, DN)
@@ -463,6 +1179,60 @@ class dhcpsubnet_show(LDAPRetrieve):
         return dn
 
 
+    def execute(self, *keys, **options):
+
+        # With --all-pools, answer everything the subnet page shows in one
+        # call: the pools come from one subtree search below the subnet,
+        # and the utilization is worked out from them and the reservations
+        # in the subnet, so its cost follows the size of the subnet rather
+        # than that of the whole tree. That relies on the dhcpStatements
+        # and aRecord indexes 89dhcp.update adds.
+
+        ret = super(dhcpsubnet_show, self).execute(*keys, **options)
+        ret['pools'] = None
+        ret['usage'] = None
+        if not options.get('all_pools'):
+            return ret
+
+        ldap = ldap_backend(self.api)
+        dn = self.obj.get_dn(*keys, **options)
+        entries = find_all_entries(
+            ldap, dn, '(|(objectclass=dhcppool)(objectclass=dhcphost))', ['*'])
+        pool_entries = [e for e in entries if get_dhcp_entry_type(e) == 'dhcppool']
+
+        pools = []
+        for entry in sorted(pool_entries, key=lambda e: e['cn'][0]):
+            dhcppool.extract_virtual_params(ldap, entry.dn, entry, keys + (entry['cn'][0],), options)
+            pool = entry_to_dict(entry, **options)
+            pool['dn'] = entry.dn
+            pools.append(pool)
+
+        # Reservations are the hosts below the subnet plus those elsewhere
+        # in cn=dhcp that are fixed to an address in it; only their names
+        # are looked up in DNS.
+
+        subnet = ret['result']
+        network = IPNetwork(u'{0}/{1}'.format(subnet['cn'][0], int(subnet['dhcpnetmask'][0])))
+        hosts = collections.OrderedDict(
+            (e.dn, e) for e in entries if get_dhcp_entry_type(e) == 'dhcphost')
+        names = []
+        for host in hosts.values():
+            value = DHCPParameterList(host.get('dhcpstatements', [])).get('fixed-address')
+            if value:
+                names.extend(resolve_fixed_address(value, {})[1])
+        (reserved, dns) = get_subnet_reservations(ldap, network)
+        for host in reserved:
+            hosts.setdefault(host.dn, host)
+        if names:
+            dns.update(get_dns_addresses(ldap, names=names))
+        usage = get_subnet_usage(
+            [(dn, network)], {dn: get_pool_ranges(pool_entries)}, list(hosts.values()), dns)
+
+        ret['pools'] = pools
+        ret['usage'] = usage[0]
+        return ret
+
+
 @register()
 class dhcpsubnet_mod(LDAPUpdate):
     __doc__ = _('Modify a DHCP subnet.')
@@ -471,27 +1241,7 @@ class dhcpsubnet_mod(LDAPUpdate):
 
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         assert isinstance(dn, DN)
-
-        entry = ldap.get_entry(dn)
-
-        if 'dhcpoption' in entry_attrs:
-            dhcpOptions = entry_attrs.get('dhcpoption', [])
-        else:
-            dhcpOptions = entry.get('dhcpoption', [])
-
-        if 'router' in options:
-            option = 'routers {0}'.format(options['router'])
-            foundOption = False
-            for i, s in enumerate(dhcpOptions):
-                if s.startswith('routers '):
-                    foundOption = True
-                    dhcpOptions[i] = option
-                    break
-            if not foundOption:
-                dhcpOptions.append(option)
-
-        entry_attrs['dhcpoption'] = dhcpOptions
-
+        apply_virtual_params(ldap, dn, entry_attrs, dhcpsubnet.virtual_params, options)
         return dn
 
 
@@ -507,6 +1257,122 @@ class dhcpsubnet_del(LDAPDelete):
     msg_summary = _('Deleted DHCP subnet "%(value)s"')
 
 
+def get_subnet_usage(subnets, pools, hosts, dns):
+
+    # Utilization of each (dn, IPNetwork) in subnets, given the pool ranges
+    # under each subnet DN (as from get_pool_ranges) and the dhcpHost
+    # entries whose fixed addresses may fall inside them. Everything is done
+    # on integer (first, last) address pairs: subnets and merged pool
+    # ranges are sorted once, and each reserved address is placed with a
+    # bisect instead of walking IPNetwork objects.
+
+    subnets.sort(key=lambda s: s[1].first)
+    firsts = [s[1].first for s in subnets]
+
+    reserved = [set() for s in subnets]
+    for host in hosts:
+        value = DHCPParameterList(host.get('dhcpstatements', [])).get('fixed-address')
+        if not value:
+            continue
+        for address in resolve_fixed_address(value, dns)[0]:
+            try:
+                address = IPAddress(address).value
+            except (ValueError, AddrFormatError):
+                continue
+            i = bisect.bisect_right(firsts, address) - 1
+            if i >= 0 and address <= subnets[i][1].last:
+                reserved[i].add(address)
+
+    result = []
+    for (i, (dn, subnet)) in enumerate(subnets):
+
+        # Clip the pool ranges to the subnet and merge them, so that
+        # overlapping pools aren't counted twice.
+
+        merged = []
+        for (start, end, pool, dhcprange) in sorted(pools.get(dn, [])):
+            start = max(start, subnet.first)
+            end = min(end, subnet.last)
+            if start > end:
+                continue
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        pooled = sum(end - start + 1 for (start, end) in merged)
+        starts = [m[0] for m in merged]
+        fixed_in_pools = 0
+        for address in reserved[i]:
+            j = bisect.bisect_right(starts, address) - 1
+            if j >= 0 and address <= merged[j][1]:
+                fixed_in_pools += 1
+
+        total = subnet.size
+        usable = total - 2 if subnet.prefixlen < 31 else total
+        fixed = len(reserved[i])
+        result.append(dict(
+            subnet=unicode(subnet.cidr),
+            total=total,
+            pooled=pooled,
+            fixed=fixed,
+            fixedinpools=fixed_in_pools,
+            free=max(usable - pooled - (fixed - fixed_in_pools), 0),
+        ))
+
+    return result
+
+
+@register()
+class dhcpsubnet_usage(Command):
+    __doc__ = _('Report address utilization of every DHCP subnet.')
+    msg_summary = ngettext(
+        '%(count)d DHCP subnet reported',
+        '%(count)d DHCP subnets reported', 0
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Utilization per subnet')),
+        Output('count', int, _('Number of subnets')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # Read every subnet, pool and host in one search.
+
+        ldap = ldap_backend(self.api)
+        entries = get_dhcp_entries(
+            ldap,
+            '(|(objectclass=dhcpsubnet)(objectclass=dhcppool)(objectclass=dhcphost))',
+            ['objectclass', 'cn', 'dhcpnetmask', 'dhcprange', 'dhcpstatements']
+        )
+
+        subnets = []
+        pools = {}
+        hosts = []
+        for entry in entries:
+            entry_type = get_dhcp_entry_type(entry)
+            if entry_type == 'dhcpsubnet':
+                try:
+                    subnets.append((entry.dn, IPNetwork(u'{0}/{1}'.format(
+                        entry['cn'][0], int(entry['dhcpnetmask'][0])))))
+                except (KeyError, ValueError, AddrFormatError):
+                    continue
+            elif entry_type == 'dhcppool':
+                pools.setdefault(entry.dn[1:], []).extend(
+                    get_pool_ranges([entry]))
+            elif entry_type == 'dhcphost':
+                hosts.append(entry)
+
+        dns = {}
+        if any(DHCPParameterList(h.get('dhcpstatements', [])).get('fixed-address') for h in hosts):
+            dns = get_dns_addresses(ldap)
+
+        result = get_subnet_usage(subnets, pools, hosts, dns)
+        return dict(result=result, count=len(result))
+
+
 #### dhcppool #################################################################
 
 
@@ -615,131 +1481,140 @@ class dhcppool(LDAPObject):
     )
 
 
+    virtual_params = permit_params + lease_time_params
+
+
     @staticmethod
     def extract_virtual_params(ldap, dn, entry_attrs, keys, options):
+        return extract_virtual_params(entry_attrs, dhcppool.virtual_params + domain_params)
 
-        dhcpPermitList = entry_attrs.get('dhcppermitlist', [])
-
-        for item in dhcpPermitList:
-            if item.endswith(' known-clients'):
-                if item.startswith('allow '):
-                    entry_attrs['permitknownclients'] = True
-                elif item.startswith('deny '):
-                    entry_attrs['permitknownclients'] = False
-            if item.endswith(' unknown-clients'):
-                if item.startswith('allow '):
-                    entry_attrs['permitunknownclients'] = True
-                elif item.startswith('deny '):
-                    entry_attrs['permitunknownclients'] = False
-
-        dhcpStatements = entry_attrs.get('dhcpstatements', [])
-
-        for statement in dhcpStatements:
-            if statement.startswith('default-lease-time '):
-                (s, v) = statement.split(' ', 1)
-                entry_attrs['defaultleasetime'] = v
-            if statement.startswith('max-lease-time '):
-                (s, v) = statement.split(' ', 1)
-                entry_attrs['maxleasetime'] = v
-
-        dhcpOptions = entry_attrs.get('dhcpoption', [])
-
-        for option in dhcpOptions:
-            if option.startswith('domain-name '):
-                (o, v) = option.split(' ', 1)
-                entry_attrs['domainname'] = v.replace('"', '')
-            if option.startswith('domain-name-servers '):
-                (o, v) = option.split(' ', 1)
-                entry_attrs['domainnameservers'] = v.split(', ')
-            if option.startswith('domain-search '):
-                (o, v) = option.split(' ', 1)
-                entry_attrs['domainsearch'] = v.replace('"', '').split(', ')
-
-        return entry_attrs
 
+def parse_dhcprange(dhcprange):
+    (start, end) = dhcprange.split()
+    return (IPAddress(start).value, IPAddress(end).value)
 
-@register()
-class dhcppool_add(LDAPCreate):
-    __doc__ = _('Create a new DHCP pool.')
-    msg_summary = _('Created DHCP pool "%(value)s"')
 
+def get_pool_ranges(entries, exclude_dn=None):
+    ranges = []
+    for entry in entries:
+        if entry.dn == exclude_dn:
+            continue
+        for dhcprange in entry.get('dhcprange', []):
+            try:
+                (start, end) = parse_dhcprange(dhcprange)
+            except (ValueError, AddrFormatError):
+                continue
+            ranges.append((start, end, entry['cn'][0], dhcprange))
+    return ranges
 
-    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
-        assert isinstance(dn, DN)
 
-        # Allow known and unknown clients by default.
+def get_pool_range_index(ldap, subnet_dn, exclude_dn=None):
+    try:
+        entries = ldap.get_entries(
+            subnet_dn,
+            ldap.SCOPE_ONELEVEL,
+            '(objectclass=dhcppool)',
+            ['cn', 'dhcprange']
+        )
+    except errors.NotFound:
+        entries = []
+    return PoolRangeIndex(get_pool_ranges(entries, exclude_dn))
 
-        entry_attrs['dhcppermitlist'] = ['allow unknown-clients', 'allow known-clients']
 
-        # If the dhcpService entry has dhcpstatements attributes that start with
-        # "default-lease-time" or "max-lease-time", grab them and copy their
-        # values into the new pool. This code could probably be a lot more
-        # efficient, but it works. The blame REALLY lies with the author of the
-        # DHCP LDAP schema for being so lazy.
+def check_pool_ranges(subnet_entry, dhcpranges, index):
 
-        hasDefaultLeaseTime = False
-        hasMaxLeaseTime = False
+    # Return None if every range fits into the subnet and overlaps neither
+    # the indexed sibling pools nor the other given ranges, or a message
+    # explaining the first problem found.
 
-        if 'dhcpstatements' in entry_attrs:
-            for statement in entry_attrs['dhcpstatements']:
-                if statement.startswith('default-lease-time'):
-                    hasDefaultLeaseTime = True
-                if statement.startswith('max-lease-time'):
-                    hasMaxLeaseTime = True
+    subnetIP = IPNetwork("{0}/{1}".format(subnet_entry['cn'][0], int(subnet_entry['dhcpNetMask'][0])))
+    first = subnetIP.first
+    last = subnetIP.last
 
-        if hasDefaultLeaseTime and hasMaxLeaseTime:
-            return dn
+    checked = []
+    for dhcprange in dhcpranges:
+        try:
+            (start, end) = parse_dhcprange(dhcprange)
+        except (ValueError, AddrFormatError):
+            return u'Range must be of the form x.x.x.x y.y.y.y.'
 
-        config = ldap.get_entry(DN(container_dn, api.env.basedn))
+        if start > end:
+            return u'First IP must come before last IP!'
 
-        if 'dhcpStatements' in config:
-            configDHCPStatements = config['dhcpStatements']
-        else:
-            configDHCPStatements = []
+        for address in (start, end):
+            if address < first or address > last:
+                return u'{0} is outside parent subnet {1}. Addresses in this pool must come from the range {2}-{3}.'.format(IPAddress(address), subnetIP.cidr, subnetIP[0], subnetIP[-1])
 
-        defaultLeaseTime = None
-        maxLeaseTime = None
+        overlap = index.find_overlap(start, end)
+        if overlap is not None:
+            return u'{0} overlaps range {1} of pool {2}.'.format(dhcprange, overlap[3], overlap[2])
 
-        for statement in configDHCPStatements:
-            if statement.startswith('default-lease-time'):
-                (s, v) = statement.split(" ")
-                defaultLeaseTime = v
-            if statement.startswith('max-lease-time'):
-                (s, v) = statement.split(" ")
-                maxLeaseTime = v
+        for (otherStart, otherEnd, other) in checked:
+            if start <= otherEnd and otherStart <= end:
+                return u'{0} overlaps range {1}.'.format(dhcprange, other)
+        checked.append((start, end, dhcprange))
 
-        if 'dhcpstatements' in entry_attrs:
-            entryDHCPStatements = entry_attrs['dhcpstatements']
-        else:
-            entryDHCPStatements = []
-
-        if defaultLeaseTime is not None:
-            foundStatement = False
-            for i, s in enumerate(entryDHCPStatements):
-                if s.startswith('default-lease-time'):
-                    foundStatement = True
-                    entryDHCPStatements[i] = 'default-lease-time {0}'.format(defaultLeaseTime)
-                    break
-            if foundStatement is False:
-                entryDHCPStatements.append('default-lease-time {0}'.format(defaultLeaseTime))
-
-        if maxLeaseTime is not None:
-            foundStatement = False
-            for i, s in enumerate(entryDHCPStatements):
-                if s.startswith('max-lease-time'):
-                    foundStatement = True
-                    maxDHCPStatements[i] = 'max-lease-time {0}'.format(maxLeaseTime)
-                    break
-            if foundStatement is False:
-                entryDHCPStatements.append('max-lease-time {0}'.format(maxLeaseTime))
+    return None
 
-        entry_attrs['dhcpstatements'] = entryDHCPStatements
 
-        return dn
+def to_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
 
 
 @register()
-class dhcppool_find(LDAPSearch):
+class dhcppool_add(LDAPCreate):
+    __doc__ = _('Create a new DHCP pool.')
+    msg_summary = _('Created DHCP pool "%(value)s"')
+
+
+    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+        assert isinstance(dn, DN)
+
+        # Refuse ranges that leave the parent subnet or overlap a sibling
+        # pool before anything else, since overlapping pools hand out
+        # conflicting leases.
+
+        subnet_dn = dn[1:]
+        subnet = ldap.get_entry(subnet_dn, ['cn', 'dhcpnetmask'])
+        error = check_pool_ranges(
+            subnet,
+            to_list(entry_attrs.get('dhcprange')),
+            get_pool_range_index(ldap, subnet_dn)
+        )
+        if error is not None:
+            raise errors.ValidationError(name='dhcprange', error=error)
+
+        # Allow known and unknown clients by default.
+
+        entry_attrs['dhcppermitlist'] = ['allow unknown-clients', 'allow known-clients']
+
+        # Copy the default-lease-time and max-lease-time statements of the
+        # dhcpService entry into the new pool unless they were given.
+
+        statements = DHCPParameterList(to_list(entry_attrs.get('dhcpstatements')))
+        missing = [k for (n, a, k, d, e) in lease_time_params if statements.get(k) is None]
+        if not missing:
+            return dn
+
+        config = DHCPParameterList(
+            self.api.Object['dhcpservice'].get_dhcpservice(ldap).get('dhcpstatements', []))
+
+        for keyword in missing:
+            value = config.get(keyword)
+            if value is not None:
+                statements.set(keyword, value)
+
+        entry_attrs['dhcpstatements'] = statements.serialize()
+
+        return dn
+
+
+@register()
+class dhcppool_find(LDAPSearch):
     __doc__ = _('Search for a DHCP pool.')
     msg_summary = ngettext(
         '%(count)d DHCP pool matched',
@@ -747,6 +1622,12 @@ class dhcppool_find(LDAPSearch):
     )
 
 
+    def post_callback(self, ldap, entries, truncated, *args, **options):
+        for entry in entries:
+            dhcppool.extract_virtual_params(ldap, entry.dn, entry, args, options)
+        return truncated
+
+
 @register()
 class dhcppool_show(LDAPRetrieve):
     __doc__ = _('Display a DHCP pool.')
@@ -767,66 +1648,18 @@ class dhcppool_mod(LDAPUpdate):
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         assert isinstance(dn, DN)
 
-        entry = ldap.get_entry(dn)
+        if 'dhcprange' in entry_attrs:
+            subnet_dn = dn[1:]
+            subnet = ldap.get_entry(subnet_dn, ['cn', 'dhcpnetmask'])
+            error = check_pool_ranges(
+                subnet,
+                to_list(entry_attrs.get('dhcprange')),
+                get_pool_range_index(ldap, subnet_dn, exclude_dn=dn)
+            )
+            if error is not None:
+                raise errors.ValidationError(name='dhcprange', error=error)
 
-
-        if 'dhcppermitlist' in entry_attrs:
-            dhcpPermitList = entry_attrs.get('dhcppermitlist', [])
-        else:
-            dhcpPermitList = entry.get('dhcppermitlist', [])
-
-        if 'permitknownclients' in options:
-            item = '{0} known-clients'.format('allow' if options['permitknownclients'] else 'deny')
-            newPermitList = [p for p in dhcpPermitList if not p.endswith(' known-clients')]
-            newPermitList.append(item)
-            dhcpPermitList = newPermitList
-
-        if 'permitunknownclients' in options:
-            item = '{0} unknown-clients'.format('allow' if options['permitunknownclients'] else 'deny')
-            newPermitList = [p for p in dhcpPermitList if not p.endswith(' unknown-clients')]
-            newPermitList.append(item)
-            dhcpPermitList = newPermitList
-
-        entry_attrs['dhcppermitlist'] = dhcpPermitList
-
-
-        if 'dhcpstatements' in entry_attrs:
-            dhcpStatements = entry_attrs.get('dhcpstatements', [])
-        else:
-            dhcpStatements = entry.get('dhcpstatements', [])
-
-        if 'defaultleasetime' in options:
-            statement = 'default-lease-time {0}'.format(options['defaultleasetime'])
-            foundStatement = False
-            for i, s in enumerate(dhcpStatements):
-                if s.startswith('default-lease-time '):
-                    foundStatement = True
-                    dhcpStatements[i] = statement
-                    break
-            if not foundStatement:
-                dhcpStatements.append(statement)
-
-        if 'maxleasetime' in options:
-            statement = 'max-lease-time {0}'.format(options['maxleasetime'])
-            foundStatement = False
-            for i, s in enumerate(dhcpStatements):
-                if s.startswith('max-lease-time '):
-                    foundStatement = True
-                    dhcpStatements[i] = statement
-                    break
-            if not foundStatement:
-                dhcpStatements.append(statement)
-
-        entry_attrs['dhcpstatements'] = dhcpStatements
-
-
-        if 'dhcpoption' in entry_attrs:
-            dhcpOptions = entry_attrs.get('dhcpoption', [])
-        else:
-            dhcpOptions = entry.get('dhcpoption', [])
-
-
-        entry_attrs['dhcpoption'] = dhcpOptions
+        apply_virtual_params(ldap, dn, entry_attrs, dhcppool.virtual_params, options)
 
         return dn
 
@@ -864,17 +1697,28 @@ class dhcppool_is_valid(Command):
         )
     )
 
+    takes_options = (
+        Str(
+            'cn?',
+            cli_name='name',
+            label=_('Name'),
+            doc=_('Name of the pool being modified, whose current ranges are ignored.')
+        ),
+    )
+
     def execute(self, *args, **kw):
+        return dhcppool_is_valid.validate(
+            ldap_backend(self.api), args[0], args[1], kw.get('cn'))
 
-        # Run some basic sanity checks on a DHCP pool IP range to make sure it
-        # fits into its parent DHCP subnet. This method looks up the parent
-        # subnet given the necessary LDAP keys because that's what works best
-        # with the GUI.
 
-        dhcpsubnetcn = args[0]
-        dhcprange = args[1][0]
+    @staticmethod
+    def validate(ldap, dhcpsubnetcn, dhcpranges, cn=None):
+
+        # Run some basic sanity checks on a DHCP pool IP range to make sure it
+        # fits into its parent DHCP subnet and doesn't overlap any other pool
+        # in it. This method looks up the parent subnet given the necessary
+        # LDAP keys because that's what works best with the GUI.
 
-        ldap = self.api.Backend.ldap2
         dn = DN(
             ('cn', dhcpsubnetcn),
             container_dn,
@@ -882,25 +1726,191 @@ class dhcppool_is_valid(Command):
         )
         try:
             entry = ldap.get_entry(dn)
-        except:
+        except errors.NotFound:
             return dict(result=False, value=u'No such subnet.')
 
-        subnetIP = IPNetwork("{0}/{1}".format(entry['cn'][0], int(entry['dhcpNetMask'][0])))
+        exclude_dn = None
+        if cn:
+            exclude_dn = DN(('cn', cn), dn)
 
-        (rangeStart, rangeEnd) = dhcprange.split(" ")
-        rangeStartIP = IPNetwork("{0}/32".format(rangeStart))
-        rangeEndIP = IPNetwork("{0}/32".format(rangeEnd))
+        error = check_pool_ranges(
+            entry,
+            dhcpranges,
+            get_pool_range_index(ldap, dn, exclude_dn)
+        )
+        if error is not None:
+            return dict(result=False, value=error)
 
-        if rangeStartIP > rangeEndIP:
-            return dict(result=False, value=u'First IP must come before last IP!')
+        return dict(result=True, value=u'Valid IP range.')
 
-        if rangeStartIP < subnetIP[0] or rangeStartIP > subnetIP[-1]:
-            return dict(result=False, value=u'{0} is outside parent subnet {1}. Addresses in this pool must come from the range {2}-{3}.'.format(rangeStartIP.ip, subnetIP.cidr, subnetIP[0], subnetIP[-1]))
 
-        if rangeEndIP < subnetIP[0] or rangeEndIP > subnetIP[-1]:
-            return dict(result=False, value=u'{0} is outside parent subnet {1}. Addresses in this pool must come from the range {2}-{3}.'.format(rangeEndIP.ip, subnetIP.cidr, subnetIP[0], subnetIP[-1]))
+def find_pool_problems(entries):
 
-        return dict(result=True, value=u'Valid IP range.')
+    # Ranges outside their subnet and overlapping ranges, for every subnet
+    # among entries, sorting each subnet's ranges once and sweeping them.
+
+    subnets = {}
+    pools = {}
+    for entry in entries:
+        entry_type = get_dhcp_entry_type(entry)
+        if entry_type == 'dhcpsubnet':
+            subnets[entry.dn] = entry
+        elif entry_type == 'dhcppool':
+            pools.setdefault(entry.dn[1:], []).append(entry)
+
+    problems = []
+    for (subnet_dn, subnet) in subnets.items():
+        subnetIP = IPNetwork("{0}/{1}".format(subnet['cn'][0], int(subnet['dhcpnetmask'][0])))
+        index = PoolRangeIndex(get_pool_ranges(pools.get(subnet_dn, [])))
+
+        for (start, end, pool, dhcprange) in index.ranges:
+            if start > end or start < subnetIP.first or end > subnetIP.last:
+                problems.append(dict(
+                    subnet=subnet['cn'][0],
+                    pool=pool,
+                    dhcprange=dhcprange,
+                    error=u'Range is outside parent subnet {0}.'.format(subnetIP.cidr)
+                ))
+
+        for (a, b) in index.find_overlaps():
+            problems.append(dict(
+                subnet=subnet['cn'][0],
+                pool=b[2],
+                dhcprange=b[3],
+                error=u'Overlaps range {0} of pool {1}.'.format(a[3], a[2])
+            ))
+
+    return problems
+
+
+@register()
+class dhcppool_check(Command):
+    __doc__ = _('Check the ranges of every DHCP pool in every subnet.')
+    msg_summary = ngettext(
+        '%(count)d DHCP pool range problem found',
+        '%(count)d DHCP pool range problems found', 0
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Pool range problems')),
+        Output('count', int, _('Number of problems found')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # Validate all ranges in all subnets from a single search.
+
+        ldap = ldap_backend(self.api)
+        entries = get_dhcp_entries(
+            ldap,
+            '(|(objectclass=dhcpsubnet)(objectclass=dhcppool))',
+            ['objectclass', 'cn', 'dhcpnetmask', 'dhcprange']
+        )
+
+        problems = find_pool_problems(entries)
+        return dict(result=problems, count=len(problems))
+
+
+@register()
+class dhcppool_leases(Command):
+    __doc__ = _('Report DHCP pool occupancy from a dhcpd.leases file.')
+    msg_summary = ngettext(
+        '%(count)d DHCP pool reported',
+        '%(count)d DHCP pools reported', 0
+    )
+
+    takes_args = (
+        File(
+            'leases',
+            cli_name='leases',
+            label=_('Leases File'),
+            doc=_('dhcpd.leases file, read on the machine the command is run '
+                  'on, normally the DHCP server.')
+        ),
+    )
+
+    takes_options = (
+        Int(
+            'threshold?',
+            cli_name='threshold',
+            label=_('Exhaustion Threshold'),
+            doc=_('Occupancy percentage from which a pool is reported at risk of exhaustion.'),
+            minvalue=1,
+            maxvalue=100,
+            default=90,
+            autofill=True
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Occupancy per pool')),
+        Output('count', int, _('Number of pools')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # Pool ranges from one search go into a sorted list so each lease
+        # is joined to its pool with a bisect. The leases file is a journal
+        # where the last declaration of an address wins, so the only state
+        # kept is whether each pooled address is currently active, which is
+        # bounded by the pool sizes rather than by the file size. The file
+        # is uploaded from the DHCP server, where dhcpd writes it, and walked
+        # line by line in place rather than copied.
+
+        ldap = ldap_backend(self.api)
+        entries = get_dhcp_entries(
+            ldap,
+            '(objectclass=dhcppool)',
+            ['cn', 'dhcprange']
+        )
+
+        ranges = []
+        stats = {}
+        for entry in entries:
+            key = (entry.dn[1].value, entry['cn'][0])
+            for (start, end, pool, dhcprange) in get_pool_ranges([entry]):
+                if start > end:
+                    continue
+                ranges.append((start, end, key))
+                stats.setdefault(key, dict(size=0, churn=0, active=set()))
+                stats[key]['size'] += end - start + 1
+        ranges.sort()
+        starts = [r[0] for r in ranges]
+
+        now = time.time()
+        for lease in iter_dhcpd_leases(iter_text_lines(args[-1])):
+            try:
+                address = IPAddress(lease['address']).value
+            except (ValueError, AddrFormatError):
+                continue
+            i = bisect.bisect_right(starts, address) - 1
+            if i < 0 or address > ranges[i][1]:
+                continue
+            pool = stats[ranges[i][2]]
+            pool['churn'] += 1
+            if lease['state'] == 'active' and (lease['ends'] is None or lease['ends'] > now):
+                pool['active'].add(address)
+            else:
+                pool['active'].discard(address)
+
+        result = []
+        for ((subnet, pool), s) in sorted(stats.items()):
+            active = len(s['active'])
+            occupancy = 100 * active // s['size'] if s['size'] else 0
+            result.append(dict(
+                subnet=subnet,
+                pool=pool,
+                size=s['size'],
+                active=active,
+                free=s['size'] - active,
+                occupancy=occupancy,
+                churn=s['churn'],
+                atrisk=occupancy >= kw['threshold'],
+            ))
+
+        return dict(result=result, count=len(result))
 
 
 #### dhcpserver ###############################################################
@@ -929,7 +1939,7 @@ class dhcpserver(LDAPObject):
             'ipapermdefaultattr': {
                 'cn', 'objectclass',
                 'dhcpservicedn',
-                'dhcpprimarydn', 'dhcpsecondarydn',
+                'dhcpprimarydn', 'dhcpsecondarydn', 'dhcpsubnetdn',
                 'dhcpstatements', 'dhcpoption', 'dhcpcomments'
             },
             'default_privileges': {'DHCP Administrators'},
@@ -974,31 +1984,93 @@ class dhcpserver(LDAPObject):
             cli_name='dhcpcomments',
             label=_('Comments'),
             doc=_('DHCP comments.')
+        ),
+        Str(
+            'dhcpsubnet*',
+            cli_name='subnet',
+            label=_('Served Subnets'),
+            doc=_('Subnets this server serves. A server without any serves every subnet.'),
+            flags=['virtual_attribute']
         )
     )
 
 
+    @staticmethod
+    def apply_subnets(ldap, entry_attrs, options):
+
+        # Served subnets are kept as dhcpSubnetDN values on the server entry
+        # and shown by network address; check all of them with one search.
+
+        if 'dhcpsubnet' not in options:
+            return entry_attrs
+        cns = list(options['dhcpsubnet'] or [])
+        if not cns:
+            entry_attrs['dhcpsubnetdn'] = None
+            return entry_attrs
+
+        filter = ldap.combine_filters([
+            ldap.make_filter_from_attr('objectclass', 'dhcpsubnet'),
+            ldap.make_filter_from_attr('cn', cns, ldap.MATCH_ANY)
+        ], ldap.MATCH_ALL)
+        try:
+            entries = ldap.get_entries(
+                DN(container_dn, api.env.basedn), ldap.SCOPE_ONELEVEL, filter, ['cn'])
+        except errors.NotFound:
+            entries = []
+        found = dict((e['cn'][0], e.dn) for e in entries)
+        missing = [cn for cn in cns if cn not in found]
+        if missing:
+            raise errors.NotFound(
+                reason=_('DHCP subnet not found: %s') % u', '.join(missing))
+        entry_attrs['dhcpsubnetdn'] = [found[cn] for cn in cns]
+        return entry_attrs
+
+
+    @staticmethod
+    def add_subnets_objectclass(ldap, dn, entry_attrs):
+
+        # dhcpSubnetDN is allowed on a server by the plugin's auxiliary
+        # ipaDhcpServer class. It is added only to servers that get served
+        # subnets, and left out of object_class, so that searches still
+        # find servers created before the class existed.
+
+        if not entry_attrs.get('dhcpsubnetdn'):
+            return entry_attrs
+        if 'objectclass' in entry_attrs:
+            objectclasses = list(entry_attrs['objectclass'])
+        else:
+            objectclasses = list(ldap.get_entry(dn, ['objectclass'])['objectclass'])
+        if 'ipadhcpserver' not in [o.lower() for o in objectclasses]:
+            entry_attrs['objectclass'] = objectclasses + ['ipadhcpserver']
+        return entry_attrs
+
+
+    @staticmethod
+    def extract_subnets(entry_attrs):
+        dns = entry_attrs.get('dhcpsubnetdn', [])
+        if dns:
+            entry_attrs['dhcpsubnet'] = [DN(dn)[0].value for dn in dns]
+        return entry_attrs
+
+
 @register()
 class dhcpserver_add(LDAPCreate):
     __doc__ = _('Create a new DHCP server.')
     msg_summary = _('Created DHCP server "%(value)s"')
 
 
-    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         assert isinstance(dn, DN)
+        dhcpserver.apply_subnets(ldap, entry_attrs, options)
+        dhcpserver.add_subnets_objectclass(ldap, dn, entry_attrs)
+        return dn
 
-        dhcpservice = ldap.get_entry(DN(container_dn, api.env.basedn))
-        dhcpsecondarydns = dhcpservice.get('dhcpsecondarydn', [])
 
-        if dn not in dhcpsecondarydns:
-            dhcpsecondarydns.append(dn)
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        assert isinstance(dn, DN)
 
-        dhcpservice['dhcpsecondarydn'] = dhcpsecondarydns
-
-        try:
-            ldap.update_entry(dhcpservice)
-        except errors.EmptyModlist:
-            pass
+        dhcpserver.extract_subnets(entry_attrs)
+        dhcpservice.modify_secondary_dns(ldap, add=[dn])
 
         return dn
 
@@ -1012,17 +2084,59 @@ class dhcpserver_find(LDAPSearch):
     )
 
 
+    def pre_callback(self, ldap, filter, attrs_list, base_dn, scope, *args, **options):
+        assert isinstance(base_dn, DN)
+        # An empty attrs_list means all attributes.
+        if attrs_list:
+            attrs_list.append('dhcpsubnetdn')
+        return (filter, base_dn, scope)
+
+
+    def post_callback(self, ldap, entries, truncated, *args, **options):
+        for entry in entries:
+            dhcpserver.extract_subnets(entry)
+        return truncated
+
+
 @register()
 class dhcpserver_show(LDAPRetrieve):
     __doc__ = _('Display a DHCP server.')
 
 
+    def pre_callback(self, ldap, dn, attrs_list, *keys, **options):
+        assert isinstance(dn, DN)
+        if attrs_list:
+            attrs_list.append('dhcpsubnetdn')
+        return dn
+
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        assert isinstance(dn, DN)
+        dhcpserver.extract_subnets(entry_attrs)
+        return dn
+
+
 @register()
 class dhcpserver_mod(LDAPUpdate):
     __doc__ = _('Modify a DHCP server.')
     msg_summary = _('Modified a DHCP server.')
 
 
+    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+        assert isinstance(dn, DN)
+        dhcpserver.apply_subnets(ldap, entry_attrs, options)
+        dhcpserver.add_subnets_objectclass(ldap, dn, entry_attrs)
+        if attrs_list:
+            attrs_list.append('dhcpsubnetdn')
+        return dn
+
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        assert isinstance(dn, DN)
+        dhcpserver.extract_subnets(entry_attrs)
+        return dn
+
+
 @register()
 class dhcpserver_del(LDAPDelete):
     __doc__ = _('Delete a DHCP server.')
@@ -1031,23 +2145,55 @@ class dhcpserver_del(LDAPDelete):
 
     def pre_callback(self, ldap, dn, *keys, **options):
         assert isinstance(dn, DN)
+        dhcpservice.modify_secondary_dns(ldap, delete=[dn])
+        return dn
 
-        dhcpservice = ldap.get_entry(DN(container_dn, api.env.basedn))
-        dhcpsecondarydns = dhcpservice.get('dhcpsecondarydn', [])
 
-        try:
-            dhcpsecondarydns.remove(dn)
-        except AttributeError, ValueError:
-            pass
+@register()
+class dhcpserver_reconcile(Command):
+    __doc__ = _('Make the DHCP service list exactly the existing DHCP servers.')
+    msg_summary = _('Added %(added)d and removed %(removed)d DHCP server references')
+
+    takes_options = (
+        Flag(
+            'dry_run',
+            cli_name='dry_run',
+            label=_('Dry Run'),
+            doc=_('Only report what would change.')
+        ),
+    )
 
-        dhcpservice['dhcpsecondarydn'] = dhcpsecondarydns
+    has_output = (
+        output.summary,
+        Output('result', dict, _('Server DNs added to and removed from the service')),
+        Output('added', int, _('Number of server references added')),
+        Output('removed', int, _('Number of server references removed')),
+    )
 
-        try:
-            ldap.update_entry(dhcpservice)
-        except errors.EmptyModlist:
-            pass
+    def execute(self, *args, **kw):
 
-        return dn
+        # One read of the service, one search for the servers, and a single
+        # modify carrying every difference between the two.
+
+        ldap = ldap_backend(self.api)
+        dhcpservice.invalidate_cached_entry()
+        service = self.api.Object['dhcpservice'].get_dhcpservice(ldap)
+        listed = set(DN(dn) for dn in service.get('dhcpsecondarydn', []))
+        servers = set(e.dn for e in get_dhcp_entries(ldap, '(objectclass=dhcpserver)', ['cn']))
+
+        add = sorted(servers - listed)
+        delete = sorted(listed - servers)
+        if not kw.get('dry_run'):
+            dhcpservice.modify_secondary_dns(ldap, add=add, delete=delete)
+
+        return dict(
+            result=dict(
+                added=[unicode(dn) for dn in add],
+                removed=[unicode(dn) for dn in delete]
+            ),
+            added=len(add),
+            removed=len(delete)
+        )
 
 
 #### dhcphost #################################################################
@@ -1118,10 +2264,227 @@ class dhcphost(LDAPObject):
             cli_name='dhcpcomments',
             label=_('Comments'),
             doc=_('DHCP comments.')
+        ),
+        Str(
+            'hostname?',
+            label=_('Hostname'),
+            doc=_('Host this DHCP host belongs to.'),
+            flags=['virtual_attribute', 'no_create', 'no_update', 'no_search']
         )
     )
 
 
+    @staticmethod
+    def get_dhcphost_cn(hostname, macaddress):
+        return u'{hostname}-{macaddress}'.format(
+            hostname=hostname,
+            macaddress=normalize_macaddress(macaddress).replace(':', '')
+        )
+
+
+    @staticmethod
+    def make_dhcphost_entry(ldap, hostname, macaddress):
+        macaddress = normalize_macaddress(macaddress)
+        cn = dhcphost.get_dhcphost_cn(hostname, macaddress)
+        return ldap.make_entry(
+            DN(('cn', cn), container_dn, api.env.basedn),
+            objectclass=['top'] + api.Object['dhcphost'].object_class,
+            cn=[cn],
+            dhcphwaddress=[u'ethernet {0}'.format(macaddress)],
+            dhcpstatements=[u'fixed-address {0}'.format(hostname)],
+            dhcpoption=[u'host-name "{0}"'.format(hostname)]
+        )
+
+
+    @staticmethod
+    def get_dhcphost_macaddress(entry):
+        for hwaddress in entry.get('dhcphwaddress', []):
+            return hwaddress.split()[-1]
+        return None
+
+
+    @staticmethod
+    def get_dhcphost_hostname(entry):
+        hostname = DHCPParameterList(entry.get('dhcpoption', [])).get('host-name')
+        if hostname:
+            return hostname.replace('"', '').lower()
+        match = re.match(r'^(.+)-((?:[a-fA-F0-9]{2}[:\-]?){5}[a-fA-F0-9]{2})$', entry['cn'][0])
+        if match:
+            return match.group(1).lower()
+        return None
+
+
+    @staticmethod
+    def make_macaddress_filter(ldap, macaddresses):
+
+        # Equality on dhcpHWAddress, which is indexed and matches regardless
+        # of case. Entries written before addresses were normalized may use
+        # dashes, so look for that spelling too.
+
+        values = []
+        for macaddress in macaddresses:
+            macaddress = normalize_macaddress(macaddress)
+            values.append(u'ethernet {0}'.format(macaddress))
+            values.append(u'ethernet {0}'.format(macaddress.replace(':', '-')))
+        return ldap.combine_filters([
+            ldap.make_filter_from_attr('objectclass', 'dhcphost'),
+            ldap.make_filter_from_attr('dhcphwaddress', values, ldap.MATCH_ANY)
+        ], ldap.MATCH_ALL)
+
+
+    @staticmethod
+    def find_macaddress_owners(ldap, macaddresses):
+
+        # Map each MAC address (normalized) to the dhcpHost entries that
+        # reserve it, with one indexed search per batch of addresses. Each
+        # address takes two filter terms, so a batch holds half of
+        # ldap_filter_batch of them.
+
+        macaddresses = sorted(set(normalize_macaddress(m) for m in macaddresses))
+        batch = ldap_filter_batch // 2
+        entries = collections.OrderedDict()
+        for i in range(0, len(macaddresses), batch):
+            for entry in find_all_entries(
+                    ldap,
+                    DN(container_dn, api.env.basedn),
+                    dhcphost.make_macaddress_filter(ldap, macaddresses[i:i + batch]),
+                    ['cn', 'dhcphwaddress', 'dhcpoption']):
+                entries.setdefault(entry.dn, entry)
+        owners = {}
+        for entry in entries.values():
+            macaddress = normalize_macaddress(dhcphost.get_dhcphost_macaddress(entry) or u'')
+            owners.setdefault(macaddress, []).append(entry)
+        return owners
+
+
+    @staticmethod
+    def find_dhcphost_entries(ldap, hostname):
+
+        # The cn of a dhcpHost is "<hostname>-<MAC>", so narrow the search
+        # down with a prefix filter and then keep only the entries whose
+        # suffix is a MAC address. That way web.example.com doesn't pick up
+        # the entries of web.example.com-backup.example.com.
+
+        prefix = u'{0}-'.format(hostname)
+        filter = ldap.combine_filters(
+            [
+                ldap.make_filter_from_attr('objectclass', 'dhcphost'),
+                ldap.make_filter(
+                    {'cn': prefix},
+                    exact=False,
+                    leading_wildcard=False,
+                    trailing_wildcard=True
+                )
+            ],
+            ldap.MATCH_ALL
+        )
+        try:
+            entries = ldap.get_entries(
+                DN(container_dn, api.env.basedn),
+                ldap.SCOPE_SUBTREE,
+                filter,
+                ['cn', 'dhcphwaddress']
+            )
+        except errors.NotFound:
+            return []
+
+        macaddress_re = re.compile(macaddress_pattern)
+        return [
+            e for e in entries
+            if e['cn'][0].startswith(prefix)
+            and macaddress_re.match(e['cn'][0][len(prefix):])
+        ]
+
+
+    @staticmethod
+    def sync_dhcphost_entries(ldap, hostname, macaddresses):
+
+        # Make the dhcpHost entries of hostname match macaddresses exactly:
+        # one search for what exists, one set difference, then every delete
+        # and add in the same pass. MACs are compared regardless of case and
+        # separator so a re-typed address doesn't churn its entry.
+
+        wanted = {}
+        for macaddress in macaddresses:
+            wanted.setdefault(normalize_macaddress(macaddress), macaddress)
+
+        stale = []
+        kept = set()
+        for entry in dhcphost.find_dhcphost_entries(ldap, hostname):
+            key = normalize_macaddress(dhcphost.get_dhcphost_macaddress(entry) or u'')
+            if key in wanted and key not in kept:
+                kept.add(key)
+                continue
+            stale.append(entry)
+
+        results = dhcphost.delete_dhcphost_entries(ldap, hostname, stale)
+        rows = [(hostname, m) for (k, m) in wanted.items() if k not in kept]
+        results.extend(dhcphost.add_dhcphost_entries(ldap, rows))
+        return results
+
+
+    @staticmethod
+    def delete_dhcphost_entries(ldap, hostname, entries):
+
+        # Delete dhcpHost entries found by find_dhcphost_entries. An entry
+        # someone else removed in the meantime counts as removed; anything
+        # else is recorded against its row.
+
+        results = []
+        for entry in entries:
+            result = dict(
+                hostname=hostname,
+                macaddress=normalize_macaddress(dhcphost.get_dhcphost_macaddress(entry) or u''),
+                cn=entry['cn'][0],
+                status=u'removed'
+            )
+            try:
+                ldap.delete_entry(entry.dn)
+            except errors.NotFound:
+                pass
+            except errors.ExecutionError as e:
+                result['status'] = u'failed'
+                result['error'] = unicode(e)
+            results.append(result)
+        return results
+
+
+    @staticmethod
+    def add_dhcphost_entries(ldap, rows):
+
+        # Add one dhcpHost entry per (hostname, macaddress) row straight
+        # through the LDAP backend, without a command round trip per row.
+        # Errors are recorded per row instead of aborting the whole batch.
+        # A MAC address can only be reserved once; all rows are checked
+        # against the existing reservations with a single search.
+
+        owners = dhcphost.find_macaddress_owners(ldap, [m for (h, m) in rows])
+        results = []
+        for (hostname, macaddress) in rows:
+            entry = dhcphost.make_dhcphost_entry(ldap, hostname, macaddress)
+            macaddress = normalize_macaddress(macaddress)
+            result = dict(
+                hostname=hostname,
+                macaddress=macaddress,
+                cn=entry['cn'][0],
+                status=u'added'
+            )
+            owner = owners.get(macaddress)
+            if owner:
+                result['status'] = u'failed'
+                result['error'] = u'MAC address is already reserved by {0}'.format(owner[0]['cn'][0])
+                results.append(result)
+                continue
+            owners[macaddress] = [entry]
+            try:
+                ldap.add_entry(entry)
+            except errors.ExecutionError as e:
+                result['status'] = u'failed'
+                result['error'] = unicode(e)
+            results.append(result)
+        return results
+
+
 @register()
 class dhcphost_add_dhcpschema(LDAPCreate):
     NO_CLI = True
@@ -1130,13 +2493,43 @@ class dhcphost_add_dhcpschema(LDAPCreate):
 
 
 @register()
-class dhcphost_find(LDAPSearch):
+class dhcphost_find(DHCPPagedSearch):
     __doc__ = _('Search for a DHCP host.')
     msg_summary = ngettext(
         '%(count)d DHCP host matched',
         '%(count)d DHCP hosts matched', 0
     )
 
+    takes_options = DHCPPagedSearch.takes_options + (
+        Str(
+            'mac?',
+            normalizer=normalize_macaddress,
+            pattern=macaddress_pattern,
+            pattern_errmsg=macaddress_errmsg,
+            cli_name='mac',
+            label=_('MAC Address'),
+            doc=_('Only return the DHCP host reserving this MAC address.')
+        ),
+    )
+
+
+    def pre_callback(self, ldap, filter, attrs_list, base_dn, scope, *args, **options):
+        assert isinstance(base_dn, DN)
+        if options.get('mac'):
+            filter = ldap.combine_filters(
+                [filter, dhcphost.make_macaddress_filter(ldap, [options['mac']])],
+                ldap.MATCH_ALL
+            )
+        return self.apply_page(ldap, filter, base_dn, scope, options)
+
+
+    def post_callback(self, ldap, entries, truncated, *args, **options):
+        for entry in entries:
+            hostname = dhcphost.get_dhcphost_hostname(entry)
+            if hostname is not None:
+                entry['hostname'] = hostname
+        return truncated
+
 
 @register()
 class dhcphost_show(LDAPRetrieve):
@@ -1165,23 +2558,29 @@ class dhcphost_add(Command):
         ),
         Str(
             'macaddress',
-            normalizer=lambda value: value.upper(),
-            pattern='^([a-fA-F0-9]{2}[:|\-]?){5}[a-fA-F0-9]{2}$',
-            pattern_errmsg=('Must be of the form HH:HH:HH:HH:HH:HH, where '
-                            'each H is a hexadecimal character.'),
+            normalizer=normalize_macaddress,
+            pattern=macaddress_pattern,
+            pattern_errmsg=macaddress_errmsg,
             cli_name='macaddress',
             label=_('MAC Address'),
             doc=_("MAC address.")
         )
     )
 
+    @staticmethod
+    def check_macaddress(ldap, macaddress):
+        owners = dhcphost.find_macaddress_owners(ldap, [macaddress])
+        if owners.get(macaddress):
+            raise errors.DuplicateEntry(
+                message=_('MAC address %(macaddress)s is already reserved by "%(owner)s"') % dict(
+                    macaddress=macaddress, owner=owners[macaddress][0]['cn'][0]))
+
+
     def execute(self, *args, **kw):
         hostname = args[0]
         macaddress = args[1]
-        cn = u'{hostname}-{macaddress}'.format(
-            hostname=hostname,
-            macaddress=macaddress.replace(':', '')
-        )
+        cn = dhcphost.get_dhcphost_cn(hostname, macaddress)
+        dhcphost_add.check_macaddress(ldap_backend(self.api), macaddress)
         result = api.Command['dhcphost_add_dhcpschema'](
             cn,
             dhcphwaddress=u'ethernet {0}'.format(macaddress),
@@ -1206,10 +2605,9 @@ class dhcphost_del(Command):
         ),
         Str(
             'macaddress',
-            normalizer=lambda value: value.upper(),
-            pattern='^([a-fA-F0-9]{2}[:|\-]?){5}[a-fA-F0-9]{2}$',
-            pattern_errmsg=('Must be of the form HH:HH:HH:HH:HH:HH, where '
-                            'each H is a hexadecimal character.'),
+            normalizer=normalize_macaddress,
+            pattern=macaddress_pattern,
+            pattern_errmsg=macaddress_errmsg,
             cli_name='macaddress',
             label=_('MAC Address'),
             doc=_("MAC address.")
@@ -1219,27 +2617,1692 @@ class dhcphost_del(Command):
     def execute(self, *args, **kw):
         hostname = args[0]
         macaddress = args[1]
-        cn = u'{hostname}-{macaddress}'.format(
-            hostname=hostname,
-            macaddress=macaddress.replace(':', '')
-        )
-        result = api.Command['dhcphost_del_dhcpschema'](cn)
+        cn = dhcphost.get_dhcphost_cn(hostname, macaddress)
+        try:
+            result = api.Command['dhcphost_del_dhcpschema'](cn)
+        except errors.NotFound:
+            # Entries added before MAC addresses were normalized are named
+            # after whatever spelling was used; find them by address.
+            owners = dhcphost.find_macaddress_owners(ldap_backend(self.api), [macaddress])
+            owners = [
+                e for e in owners.get(macaddress, [])
+                if dhcphost.get_dhcphost_hostname(e) == hostname.lower()
+            ]
+            if not owners:
+                raise
+            cn = owners[0]['cn'][0]
+            result = api.Command['dhcphost_del_dhcpschema'](cn)
         return dict(result=result['result'], value=cn)
 
 
+@register()
+class dhcphost_import(Command):
+    __doc__ = _('Create DHCP hosts in bulk from a CSV or JSON list.')
+    msg_summary = _('Imported %(count)d DHCP hosts, %(failed)d failed')
+
+    takes_args = (
+        File(
+            'data',
+            cli_name='file',
+            label=_('Reservations'),
+            doc=_('CSV rows of "hostname,macaddress" or a JSON list of '
+                  '{"hostname": ..., "macaddress": ...} objects.')
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Per-row results')),
+        Output('count', int, _('Number of DHCP hosts created')),
+        Output('failed', int, _('Number of rows that could not be added')),
+    )
+
+
+    @staticmethod
+    def parse_rows(data):
+        text = data.strip()
+        if text.startswith('['):
+            try:
+                items = json.loads(text)
+            except ValueError as e:
+                raise errors.ValidationError(name='data', error=unicode(e))
+            rows = []
+            for item in items:
+                # Anything but an object or a list comes back as an empty
+                # row, which execute reports as invalid.
+                if isinstance(item, dict):
+                    rows.append((item.get('hostname'), item.get('macaddress')))
+                elif isinstance(item, (list, tuple)):
+                    rows.append(tuple(item))
+                else:
+                    rows.append(())
+            return rows
+
+        rows = []
+        for row in csv.reader(text.encode('utf-8').splitlines()):
+            row = [c.decode('utf-8').strip() for c in row]
+            if not row or not any(row) or row[0].startswith('#'):
+                continue
+            if row[0].lower() == 'hostname':
+                continue
+            rows.append(tuple(row))
+        return rows
+
+
+    def execute(self, *args, **kw):
+
+        # Validate every row before touching LDAP, so a typo on line 9000
+        # doesn't leave a half imported list behind.
+
+        rows = []
+        invalid = []
+        macaddress_re = re.compile(macaddress_pattern)
+        for (i, row) in enumerate(dhcphost_import.parse_rows(args[0]), 1):
+            if len(row) != 2 or not all(row) or not all(isinstance(c, basestring) for c in row):
+                invalid.append(u'row {0}: expected hostname and MAC address'.format(i))
+                continue
+            (hostname, macaddress) = (unicode(row[0]), normalize_macaddress(unicode(row[1])))
+            if not macaddress_re.match(macaddress):
+                invalid.append(u'row {0}: {1}: {2}'.format(i, macaddress, macaddress_errmsg))
+                continue
+            rows.append((hostname, macaddress))
+
+        if invalid:
+            raise errors.ValidationError(name='data', error=u'; '.join(invalid))
+
+        ldap = ldap_backend(self.api)
+        results = dhcphost.add_dhcphost_entries(ldap, rows)
+        failed = len([r for r in results if r['status'] != u'added'])
+        return dict(result=results, count=len(results) - failed, failed=failed)
+
+
+#### dhcp #####################################################################
+
+
+def find_all_entries(ldap, base_dn, filter=None, attrs_list=None):
+    """
+    Return every entry under base_dn matching filter. The whole subtree is
+    read with a single paged search, so this is safe to use on trees that
+    are bigger than the server size limit.
+    """
+    try:
+        (entries, truncated) = ldap.find_entries(
+            filter,
+            attrs_list,
+            base_dn,
+            ldap.SCOPE_SUBTREE,
+            size_limit=0,
+            paged_search=True
+        )
+    except errors.NotFound:
+        return []
+    ldap.handle_truncated_result(truncated)
+    return entries
+
+
+def get_dhcp_entries(ldap, filter=None, attrs_list=None):
+    return find_all_entries(ldap, DN(container_dn, api.env.basedn), filter, attrs_list)
+
+
+def find_any_entries(ldap, base_dn, terms, filter=None, attrs_list=None):
+
+    # Every entry under base_dn matching filter and any of terms (filter
+    # strings), searching ldap_filter_batch terms at a time so that a long
+    # list doesn't turn into one huge OR filter. An entry matched by more
+    # than one batch is returned once.
+
+    terms = list(terms)
+    entries = collections.OrderedDict()
+    for i in range(0, len(terms), ldap_filter_batch):
+        batch = u'(|{0})'.format(u''.join(terms[i:i + ldap_filter_batch]))
+        if filter:
+            batch = u'(&{0}{1})'.format(filter, batch)
+        for entry in find_all_entries(ldap, base_dn, batch, attrs_list):
+            entries.setdefault(entry.dn, entry)
+    return list(entries.values())
+
+
+def get_network_terms(attr, network, prefix=u''):
+
+    # Filter terms matching the values of attr that are prefix followed by
+    # an address in network. The values are strings, so the network is
+    # covered by whole-octet substrings ("10.1.2.*"), or by exact
+    # addresses past a /24: at most 128 terms for any prefix length.
+
+    octets = (network.prefixlen + 7) // 8
+    step = 1 << (32 - 8 * octets)
+    terms = []
+    for first in range(network.first, network.last + 1, step):
+        parts = unicode(IPAddress(first)).split('.')[:octets]
+        if octets == 4:
+            terms.append(u'({0}={1})'.format(attr, escape_filter_chars(prefix + u'.'.join(parts))))
+        else:
+            value = escape_filter_chars(prefix + u''.join(p + u'.' for p in parts))
+            terms.append(u'({0}={1}*)'.format(attr, value))
+    return terms
+
+
+def get_dns_addresses(ldap, attrs=('arecord',), names=None):
+    """
+    Map names in IPA DNS (lower case, without the trailing dot) to their
+    addresses. Without names, all of cn=dns is read with one search; with
+    names, only the records that could hold one of them are looked up, so
+    the cost follows the number of names. Returns an empty map if IPA
+    doesn't manage DNS.
+    """
+    present = u'(|{0})'.format(u''.join(u'({0}=*)'.format(a) for a in attrs))
+    base_dn = DN(api.env.container_dns, api.env.basedn)
+    if names is None:
+        entries = find_all_entries(ldap, base_dn, present, ['idnsname'] + list(attrs))
+        return map_dns_addresses(entries, attrs)
+
+    # A record may be named relative to any zone above it, so look for
+    # every leading run of labels of each name.
+
+    names = set(n.rstrip('.').lower() for n in names)
+    labels = set()
+    for name in names:
+        parts = name.split('.')
+        labels.update(u'.'.join(parts[:i]) for i in range(1, len(parts)))
+    entries = find_any_entries(
+        ldap,
+        base_dn,
+        [u'(idnsname={0})'.format(escape_filter_chars(l)) for l in sorted(labels)],
+        present,
+        ['idnsname'] + list(attrs)
+    )
+    addresses = map_dns_addresses(entries, attrs)
+    return dict((n, a) for (n, a) in addresses.items() if n in names)
+
+
+def get_dns_record_name(dn):
+
+    # The name a record entry in cn=dns is for (lower case, without the
+    # trailing dot): its idnsname RDNs up to and including the zone.
+
+    labels = []
+    for rdn in dn:
+        if rdn.attr.lower() != 'idnsname':
+            break
+        labels.append(rdn.value)
+        if rdn.value.endswith('.'):
+            break
+    if not labels:
+        return None
+    return u'.'.join(labels).rstrip('.').lower()
+
+
+def map_dns_addresses(entries, attrs):
+    addresses = {}
+    for entry in entries:
+        name = get_dns_record_name(entry.dn)
+        if name is None:
+            continue
+        for attr in attrs:
+            addresses.setdefault(name, []).extend(entry.get(attr, []))
+    return addresses
+
+
+def get_subnet_reservations(ldap, network):
+
+    # The dhcpHost entries whose fixed address falls in network, and the
+    # DNS addresses of their names, without reading all of cn=dhcp or
+    # cn=dns: DNS is searched for the names with an address in network,
+    # and cn=dhcp for the hosts fixed to one of those names or to a literal
+    # address in network. Hosts are matched on the single-name
+    # fixed-address statement the plugin writes.
+
+    dns = map_dns_addresses(find_any_entries(
+        ldap,
+        DN(api.env.container_dns, api.env.basedn),
+        get_network_terms('arecord', network),
+        None,
+        ['idnsname', 'arecord']
+    ), ('arecord',))
+
+    terms = [
+        u'(dhcpstatements={0})'.format(escape_filter_chars(u'fixed-address ' + name))
+        for name in sorted(dns)
+    ]
+    terms.extend(get_network_terms('dhcpstatements', network, u'fixed-address '))
+    hosts = find_any_entries(
+        ldap,
+        DN(container_dn, api.env.basedn),
+        terms,
+        '(objectclass=dhcphost)',
+        ['objectclass', 'dhcpstatements']
+    )
+    return (hosts, dns)
+
+
+def resolve_fixed_address(value, dns):
+
+    # Split a fixed-address statement value into its addresses, looking
+    # host names up in the map built by get_dns_addresses. Returns the
+    # addresses and the names that couldn't be resolved.
+
+    resolved = []
+    unresolved = []
+    for name in value.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        try:
+            resolved.append(unicode(IPAddress(name)))
+            continue
+        except (ValueError, AddrFormatError):
+            pass
+        found = dns.get(name.rstrip('.').lower())
+        if found:
+            resolved.extend(found)
+        else:
+            unresolved.append(name)
+    return (resolved, unresolved)
+
+
+def get_dhcp_entry_type(entry):
+    objectclasses = [o.lower() for o in entry.get('objectclass', [])]
+    for t in ('dhcpservice', 'dhcpsubnet', 'dhcppool', 'dhcphost', 'dhcpserver'):
+        if t in objectclasses:
+            return t
+    return None
+
+
+def resolve_host_statements(entry, dns, unresolved):
+
+    # The dhcpStatements of a host with each fixed-address name replaced by
+    # its addresses in dns (as built by get_dns_addresses), so that dhcpd
+    # doesn't have to look every reservation up itself. Names without a
+    # record are left for dhcpd to resolve and added to unresolved.
+
+    statements = []
+    for statement in entry.get('dhcpstatements', []):
+        parts = statement.split(' ', 1)
+        if parts[0] != 'fixed-address' or len(parts) < 2:
+            statements.append(statement)
+            continue
+        (addresses, names) = resolve_fixed_address(parts[1], dns)
+        unresolved.extend(names)
+        statements.append(u'fixed-address {0}'.format(u', '.join(addresses + names)))
+    return statements
+
+
+def render_dhcpd_parameters(entry, indent, statements=None):
+    if statements is None:
+        statements = entry.get('dhcpstatements', [])
+    lines = []
+    for comment in entry.get('dhcpcomments', []):
+        for line in comment.splitlines():
+            lines.append(u'{0}# {1}'.format(indent, line))
+    for statement in statements:
+        lines.append(u'{0}{1};'.format(indent, statement))
+    for option in entry.get('dhcpoption', []):
+        lines.append(u'{0}option {1};'.format(indent, option))
+    return lines
+
+
+def render_dhcpd_host(entry, indent, statements=None):
+    lines = [u'{0}host {1} {{'.format(indent, entry['cn'][0])]
+    for hwaddress in entry.get('dhcphwaddress', []):
+        lines.append(u'{0}    hardware {1};'.format(indent, hwaddress))
+    lines.extend(render_dhcpd_parameters(entry, indent + u'    ', statements))
+    lines.append(u'{0}}}'.format(indent))
+    return lines
+
+
+def render_dhcpd_pool(entry, indent):
+    lines = [u'{0}pool {{'.format(indent)]
+    for dhcprange in entry.get('dhcprange', []):
+        lines.append(u'{0}    range {1};'.format(indent, dhcprange))
+    for permit in entry.get('dhcppermitlist', []):
+        lines.append(u'{0}    {1};'.format(indent, permit))
+    lines.extend(render_dhcpd_parameters(entry, indent + u'    '))
+    lines.append(u'{0}}}'.format(indent))
+    return lines
+
+
+def render_dhcpd_subnet_header(entry):
+    subnet = IPNetwork(u'{0}/{1}'.format(entry['cn'][0], entry['dhcpnetmask'][0]))
+    lines = [u'subnet {0} netmask {1} {{'.format(subnet.network, subnet.netmask)]
+    lines.extend(render_dhcpd_parameters(entry, u'    '))
+    return lines
+
+
+def render_dhcpd_entry(entry_type, entry, indent, statements=None):
+    if entry_type == 'dhcppool':
+        return render_dhcpd_pool(entry, indent)
+    return render_dhcpd_host(entry, indent, statements)
+
+
+def get_dhcpd_layout(entries):
+
+    # The order dhcpd.conf declares entries in, as (dn, child dns) pairs:
+    # the service with its hosts, then each subnet with its pools and
+    # hosts. Everything is sorted on cn, which is the RDN, so the layout
+    # only changes when entries come, go or are renamed.
+
+    service = None
+    subnets = []
+    children = {}
+    for entry in entries:
+        entry_type = get_dhcp_entry_type(entry)
+        if entry_type == 'dhcpservice':
+            service = entry
+        elif entry_type == 'dhcpsubnet':
+            subnets.append(entry)
+        elif entry_type in ('dhcppool', 'dhcphost'):
+            children.setdefault(entry.dn[1:], []).append(entry)
+
+    def child_dns(parent):
+        return [e.dn for e in sorted(children.get(parent.dn, []), key=lambda e: e['cn'][0])]
+
+    layout = []
+    if service is not None:
+        layout.append((service.dn, child_dns(service)))
+    for subnet in sorted(subnets, key=lambda s: IPAddress(s['cn'][0]).value):
+        layout.append((subnet.dn, child_dns(subnet)))
+    return layout
+
+
+def render_dhcpd_conf(entries, blocks=None, dns=None, unresolved=None, layout=None):
+    """
+    Render entries read from cn=dhcp to the dhcpd.conf that dhcpd would have
+    built from the same tree with ldap-method static. Global parameters come
+    first, then global host declarations, then the subnets (sorted by network
+    address) with their pools and hosts nested inside.
+
+    If blocks is given, it maps DNs to already rendered text: a pool or host
+    block, the parameters of the service, or a whole subnet with everything
+    in it. Missing blocks are rendered and stored back, so a caller that
+    drops the blocks of changed entries (including hosts whose addresses in
+    DNS changed) and of their parents only renders those again. layout, as
+    from get_dhcpd_layout, saves sorting entries that haven't come or gone.
+
+    If dns is given, fixed-address names are written out as the addresses
+    it maps them to, and names it has no address for are appended to
+    unresolved.
+    """
+    if blocks is None:
+        blocks = {}
+    if unresolved is None:
+        unresolved = []
+    if not isinstance(entries, dict):
+        entries = dict((e.dn, e) for e in entries)
+    if layout is None:
+        layout = get_dhcpd_layout(entries.values())
+
+    def child_block(dn, indent):
+        # A host block is stored along with the names it couldn't resolve,
+        # so that they are reported again on every export.
+        block = blocks.get(dn)
+        if block is not None:
+            return (block, False)
+        entry = entries[dn]
+        entry_type = get_dhcp_entry_type(entry)
+        statements = None
+        names = []
+        if entry_type == 'dhcphost' and dns is not None:
+            statements = resolve_host_statements(entry, dns, names)
+        block = blocks[dn] = (u'\n'.join(
+            render_dhcpd_entry(entry_type, entry, indent, statements)), names)
+        return (block, True)
+
+    pieces = [u'# dhcpd.conf generated from {0}'.format(DN(container_dn, api.env.basedn))]
+
+    for (dn, child_dns) in layout:
+        entry = entries[dn]
+        if get_dhcp_entry_type(entry) == 'dhcpservice':
+            block = blocks.get(dn)
+            if block is None:
+                block = blocks[dn] = (u'\n'.join(render_dhcpd_parameters(entry, u'')), [])
+            if block[0]:
+                pieces.append(block[0])
+            for child_dn in child_dns:
+                (child, fresh) = child_block(child_dn, u'')
+                unresolved.extend(child[1])
+                pieces.append(u'')
+                pieces.append(child[0])
+            continue
+
+        children = [child_block(child_dn, u'    ') for child_dn in child_dns]
+        block = blocks.get(dn)
+        if block is None or any(fresh for (child, fresh) in children):
+            block = blocks[dn] = (u'\n'.join(
+                render_dhcpd_subnet_header(entry) + [c[0] for (c, fresh) in children] + [u'}']), [])
+        for (child, fresh) in children:
+            unresolved.extend(child[1])
+        pieces.append(u'')
+        pieces.append(block[0])
+
+    return u'\n'.join(pieces) + u'\n'
+
+
+def kea_option_data(entry):
+
+    # dhcpOption values are "<name> <data>" in dhcpd syntax. Kea knows the
+    # standard options by the same names and takes the data unquoted.
+
+    options = []
+    for option in entry.get('dhcpoption', []):
+        parts = option.split(' ', 1)
+        if len(parts) < 2:
+            continue
+        options.append(collections.OrderedDict([
+            ('name', parts[0]),
+            ('data', parts[1].replace('"', ''))
+        ]))
+    return options
+
+
+def kea_lifetimes(entry, target):
+    statements = DHCPParameterList(entry.get('dhcpstatements', []))
+    for (keyword, name) in (('default-lease-time', 'valid-lifetime'),
+                            ('min-lease-time', 'min-valid-lifetime'),
+                            ('max-lease-time', 'max-valid-lifetime')):
+        value = statements.get(keyword)
+        if value is None:
+            continue
+        try:
+            target[name] = int(value)
+        except ValueError:
+            pass
+    return target
+
+
+def kea_client_class(entry):
+
+    # Translate a pool's dhcpd permit list to the client class Kea uses to
+    # guard the pool. As in dhcpd, once anything is allowed explicitly every
+    # client that isn't is denied. Returns (client class or None, usable);
+    # a pool no client may use has no Kea equivalent.
+
+    allowed = {}
+    members = None
+    for permit in entry.get('dhcppermitlist', []):
+        words = permit.replace('"', '').split()
+        if len(words) == 4 and words[1:3] == ['members', 'of']:
+            if words[0] == 'allow':
+                members = words[3]
+        elif len(words) == 2:
+            allowed[words[1]] = (words[0] == 'allow')
+
+    if members is not None:
+        return (members, True)
+    default = True not in allowed.values()
+    known = allowed.get('known-clients', default)
+    unknown = allowed.get('unknown-clients', default)
+    if known and unknown:
+        return (None, True)
+    if known:
+        return (u'KNOWN', True)
+    if unknown:
+        return (u'UNKNOWN', True)
+    return (None, False)
+
+
+def kea_pools(entry):
+    (client_class, usable) = kea_client_class(entry)
+    if not usable:
+        return []
+    pools = []
+    for dhcprange in entry.get('dhcprange', []):
+        (start, end) = dhcprange.split()
+        pool = collections.OrderedDict([('pool', u'{0} - {1}'.format(start, end))])
+        if client_class is not None:
+            pool['client-class'] = client_class
+        options = kea_option_data(entry)
+        if options:
+            pool['option-data'] = options
+        # Kea sets lease lifetimes per subnet only, so keep the pool's own
+        # where an operator can still see them.
+        lifetimes = kea_lifetimes(entry, collections.OrderedDict())
+        if lifetimes:
+            pool['user-context'] = lifetimes
+        pools.append(pool)
+    return pools
+
+
+def kea_reservation(entry, address):
+    reservation = collections.OrderedDict()
+    macaddress = dhcphost.get_dhcphost_macaddress(entry)
+    if macaddress is not None:
+        reservation['hw-address'] = macaddress.lower().replace('-', ':')
+    if address is not None:
+        reservation['ip-address'] = address
+    hostname = DHCPParameterList(entry.get('dhcpoption', [])).get('host-name')
+    if hostname:
+        reservation['hostname'] = hostname.replace('"', '')
+    options = [o for o in kea_option_data(entry) if o['name'] != 'host-name']
+    if options:
+        reservation['option-data'] = options
+    return reservation
+
+
+def iter_kea_dhcp4(entries, dns):
+    """
+    Render entries read from cn=dhcp as a Kea Dhcp4 configuration using the
+    memfile lease backend, so Kea can answer requests without going to LDAP.
+    The JSON text is yielded a piece at a time, one piece per subnet and one
+    per reservation, but the entries and the reservations built from them
+    are all held in memory, and dhcp_export joins the pieces into a single
+    result.
+
+    Kea reservations need an address, so the fixed-address of every host is
+    looked up in dns (as built by get_dns_addresses) and the reservation is
+    placed in the subnet containing it. Hosts whose address is in no subnet
+    become global reservations.
+    """
+    service = None
+    subnets = {}
+    pools = {}
+    trie = SubnetTrie()
+    hosts = []
+
+    for entry in entries:
+        entry_type = get_dhcp_entry_type(entry)
+        if entry_type == 'dhcpservice':
+            service = entry
+        elif entry_type == 'dhcpsubnet':
+            network = IPNetwork(u'{0}/{1}'.format(entry['cn'][0], entry['dhcpnetmask'][0]))
+            subnets[entry.dn] = (network, entry)
+            trie.insert(network.first, network.prefixlen, entry.dn)
+        elif entry_type == 'dhcppool':
+            pools.setdefault(entry.dn[1:], []).append(entry)
+        elif entry_type == 'dhcphost':
+            hosts.append(entry)
+
+    reservations = {}
+    for entry in sorted(hosts, key=lambda e: e['cn'][0]):
+        value = DHCPParameterList(entry.get('dhcpstatements', [])).get('fixed-address')
+        (addresses, unresolved) = resolve_fixed_address(value or u'', dns)
+        parent = entry.dn[1:] if entry.dn[1:] in subnets else None
+        placed = (parent, None)
+        for address in addresses:
+            found = trie.find_containing(IPAddress(address).value)
+            if parent is None and found:
+                placed = (found[-1], address)
+                break
+            if parent is not None and parent in found:
+                placed = (parent, address)
+                break
+        reservations.setdefault(placed[0], []).append(kea_reservation(entry, placed[1]))
+
+    def iter_reservations(parent):
+        for (i, reservation) in enumerate(reservations.get(parent, [])):
+            yield (u',\n' if i else u'\n') + json.dumps(reservation)
+
+    head = collections.OrderedDict()
+    head['lease-database'] = collections.OrderedDict([
+        ('type', 'memfile'),
+        ('persist', True),
+        ('lfc-interval', 3600)
+    ])
+    if service is not None:
+        kea_lifetimes(service, head)
+        options = kea_option_data(service)
+        if options:
+            head['option-data'] = options
+    if None in reservations:
+        head['reservations-global'] = True
+        head['reservations-in-subnet'] = True
+
+    yield u'{"Dhcp4": ' + json.dumps(head)[:-1]
+    if None in reservations:
+        yield u',\n"reservations": ['
+        for piece in iter_reservations(None):
+            yield piece
+        yield u']'
+
+    yield u',\n"subnet4": ['
+    ordered = sorted(subnets.items(), key=lambda s: (s[1][0].first, s[1][0].prefixlen))
+    ids = get_kea_subnet_ids([network for (dn, (network, entry)) in ordered])
+    for (i, (dn, (network, entry))) in enumerate(ordered):
+        subnet = collections.OrderedDict()
+        subnet['id'] = ids[network]
+        subnet['subnet'] = unicode(network.cidr)
+        kea_lifetimes(entry, subnet)
+        subnet['option-data'] = [collections.OrderedDict([
+            ('name', 'subnet-mask'),
+            ('data', unicode(network.netmask))
+        ])] + [o for o in kea_option_data(entry) if o['name'] != 'subnet-mask']
+        subnet['pools'] = []
+        for pool in sorted(pools.get(dn, []), key=lambda p: p['cn'][0]):
+            subnet['pools'].extend(kea_pools(pool))
+        yield (u',\n' if i else u'\n') + json.dumps(subnet)[:-1] + u', "reservations": ['
+        for piece in iter_reservations(dn):
+            yield piece
+        yield u']}'
+    yield u'\n]}}\n'
+
+
+def get_entry_usn(entry):
+    try:
+        return int(entry['entryusn'][0])
+    except (KeyError, IndexError, ValueError):
+        return 0
+
+
+def new_export_cache():
+    return dict(
+        lock=threading.Lock(), usn=None, entries={}, ids={}, blocks={},
+        layout=None, dns_usn=None, names={}, dns={})
+
+
+def get_export_cache(ldap):
+
+    # The entries, layout, rendered blocks and DNS addresses kept between
+    # exports, so that an export only has to read and render what changed
+    # since the highest entryUSN seen. What was read depends on who read
+    # it, so there is one cache per bind DN: one caller's view of cn=dhcp
+    # and cn=dns is never handed to another. Only the callers seen last
+    # keep theirs.
+
+    with ldap.error_handler():
+        identity = ldap.conn.whoami_s()
+    with export_caches_lock:
+        cache = export_caches.pop(identity, None)
+        if cache is None:
+            cache = new_export_cache()
+        export_caches[identity] = cache
+        while len(export_caches) > export_caches_limit:
+            export_caches.popitem(last=False)
+    return cache
+
+
+def drop_export_blocks(cache, dn):
+
+    # A changed entry's block is rendered again, and so is every block it
+    # is part of: the subnet a pool or host is nested in.
+
+    base_dn = DN(container_dn, api.env.basedn)
+    while len(dn) >= len(base_dn):
+        cache['blocks'].pop(dn, None)
+        dn = dn[1:]
+
+
+def get_fixed_address_names(entry):
+
+    # The host names (as keys of get_dns_addresses) in the fixed-address
+    # statements of a dhcpHost entry.
+
+    names = set()
+    for statement in entry.get('dhcpstatements', []):
+        parts = statement.split(' ', 1)
+        if parts[0] == 'fixed-address' and len(parts) > 1:
+            names.update(n.rstrip('.').lower() for n in resolve_fixed_address(parts[1], {})[1])
+    return names
+
+
+def index_export_host(cache, dn, entry):
+
+    # Keep cache['names'] (name -> DNs of the hosts fixed to it) in
+    # step with a host entry that was added (entry), changed (entry) or
+    # removed (None), and return the names it now uses that weren't
+    # looked up yet.
+
+    old = cache['entries'].get(dn)
+    if old is not None and get_dhcp_entry_type(old) == 'dhcphost':
+        for name in get_fixed_address_names(old):
+            hosts = cache['names'].get(name, set())
+            hosts.discard(dn)
+            if not hosts:
+                cache['names'].pop(name, None)
+                cache['dns'].pop(name, None)
+    if entry is None or get_dhcp_entry_type(entry) != 'dhcphost':
+        return set()
+    names = get_fixed_address_names(entry)
+    for name in names:
+        cache['names'].setdefault(name, set()).add(dn)
+    return set(n for n in names if n not in cache['dns'])
+
+
+def update_export_dns(ldap, cache, names):
+
+    # Look names up in IPA DNS and drop the blocks of the hosts fixed to
+    # them; names without an address are kept out of cache['dns'].
+
+    names = set(n for n in names if n in cache['names'])
+    if not names:
+        return
+    found = get_dns_addresses(ldap, names=names)
+    for name in names:
+        if name in found:
+            cache['dns'][name] = found[name]
+        else:
+            cache['dns'].pop(name, None)
+        for dn in cache['names'][name]:
+            drop_export_blocks(cache, dn)
+
+
+def update_export_cache(ldap, cache, full=False):
+    """
+    Bring an export cache (see get_export_cache) up to date with cn=dhcp
+    and return the number of entries that were read. The first call (or full=True) reads the whole
+    tree; later calls only read entries and tombstones whose entryUSN is
+    above the highest one already rendered. Entries are also tracked by
+    nsUniqueId, so one that was renamed drops its old DN. Without the USN
+    plugin there is nothing to compare against, so every call falls back
+    to a full read.
+
+    The addresses of the names hosts are fixed to are cached as well, in
+    cache['dns']. Only the names of changed hosts are looked up,
+    along with names whose records in cn=dns changed since the last call.
+    Both are read with the caller's own bind, into that caller's cache.
+
+    Caches live in the server process, so whether a call is incremental
+    depends on which process serves it: the first call a process gets
+    from a caller always reads everything.
+    """
+    attrs_list = ['*', 'entryusn', 'nsuniqueid']
+
+    if full or not cache['usn']:
+        entries = get_dhcp_entries(ldap, None, attrs_list)
+        cache['entries'] = {}
+        cache['ids'] = {}
+        cache['blocks'] = {}
+        cache['layout'] = None
+        cache['names'] = {}
+        cache['dns'] = {}
+        names = set()
+        for entry in entries:
+            names.update(index_export_host(cache, entry.dn, entry))
+            cache['entries'][entry.dn] = entry
+            if 'nsuniqueid' in entry:
+                cache['ids'][entry['nsuniqueid'][0]] = entry.dn
+        update_export_dns(ldap, cache, names)
+        cache['usn'] = max([get_entry_usn(e) for e in entries] or [0])
+        cache['dns_usn'] = cache['usn']
+        return len(entries)
+
+    usn = cache['usn']
+    changed = get_dhcp_entries(
+        ldap, u'(entryusn>={0})'.format(usn + 1), attrs_list)
+    tombstones = get_dhcp_entries(
+        ldap,
+        u'(&(objectclass=nstombstone)(entryusn>={0}))'.format(usn + 1),
+        ['nscpentrydn', 'nsuniqueid', 'entryusn']
+    )
+
+    def drop(dn):
+        index_export_host(cache, dn, None)
+        if cache['entries'].pop(dn, None) is not None:
+            cache['layout'] = None
+        drop_export_blocks(cache, dn)
+
+    for tombstone in tombstones:
+        if 'nscpentrydn' in tombstone:
+            drop(DN(tombstone['nscpentrydn'][0]))
+        if 'nsuniqueid' in tombstone:
+            cache['ids'].pop(tombstone['nsuniqueid'][0], None)
+        usn = max(usn, get_entry_usn(tombstone))
+
+    names = set()
+    for entry in changed:
+        if 'nsuniqueid' in entry:
+            old_dn = cache['ids'].get(entry['nsuniqueid'][0])
+            if old_dn is not None and old_dn != entry.dn:
+                drop(old_dn)
+            cache['ids'][entry['nsuniqueid'][0]] = entry.dn
+        if entry.dn not in cache['entries']:
+            cache['layout'] = None
+        names.update(index_export_host(cache, entry.dn, entry))
+        cache['entries'][entry.dn] = entry
+        drop_export_blocks(cache, entry.dn)
+        usn = max(usn, get_entry_usn(entry))
+
+    # Records in cn=dns changed or deleted since the last call: hosts fixed
+    # to their names are resolved and rendered again.
+
+    dns_usn = cache['dns_usn']
+    dns_base_dn = DN(api.env.container_dns, api.env.basedn)
+    for entry in find_all_entries(
+            ldap, dns_base_dn,
+            u'(|(entryusn>={0})(&(objectclass=nstombstone)(entryusn>={0})))'.format(
+                dns_usn + 1),
+            ['nscpentrydn', 'entryusn']):
+        dn = entry.dn
+        if 'nscpentrydn' in entry:
+            dn = DN(entry['nscpentrydn'][0])
+        names.add(get_dns_record_name(dn))
+        dns_usn = max(dns_usn, get_entry_usn(entry))
+    update_export_dns(ldap, cache, names)
+
+    cache['usn'] = usn
+    cache['dns_usn'] = dns_usn
+    return len(changed) + len(tombstones)
+
+
+class DHCPUnresolvedNames(messages.PublicMessage):
+    """
+    **13101** Some fixed-address names have no address in IPA DNS.
+    """
+
+    errno = 13101
+    type = 'warning'
+    format = _('No address in IPA DNS for %(count)d fixed-address names, '
+               'left for dhcpd to resolve: %(names)s')
+
+
+def report_unresolved_names(command, unresolved):
+    if not unresolved:
+        return
+    names = sorted(set(unresolved))
+    logger.warning('dhcp: no address in IPA DNS for %s', u', '.join(names))
+    command.add_message(DHCPUnresolvedNames(
+        count=len(names),
+        names=u', '.join(names[:20]) + (u', ...' if len(names) > 20 else u'')
+    ))
+
+
+@register()
+class dhcp_export(Command):
+    __doc__ = _('Export the DHCP configuration as a dhcpd.conf file or a Kea Dhcp4 configuration.')
+    msg_summary = _('Exported %(count)d DHCP entries')
+
+    takes_options = (
+        StrEnum(
+            'format?',
+            cli_name='format',
+            label=_('Format'),
+            doc=_('Configuration format: dhcpd (ISC dhcpd.conf) or kea (Kea Dhcp4 JSON).'),
+            values=(u'dhcpd', u'kea'),
+            default=u'dhcpd',
+            autofill=True
+        ),
+        Flag(
+            'full',
+            cli_name='full',
+            label=_('Full Export'),
+            doc=_('Re-read the whole DHCP tree instead of only the entries changed since the last export. The last export is the last one this server process made for the same user, so a request served by another process is a full export anyway.')
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', unicode, _('Configuration contents')),
+        Output('count', int, _('Number of entries exported')),
+        Output('changed', int, _('Number of entries read from LDAP')),
+        Output('usn', int, _('Highest entryUSN rendered')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # Read the whole cn=dhcp tree in one search and render it locally,
+        # instead of letting dhcpd walk the tree one entry at a time. After
+        # the first export only the entries whose entryUSN moved are read
+        # again, and only their blocks and the subnets they are in are
+        # rendered again; the rest is put together from cached text. Fixed
+        # addresses come from the cached DNS addresses, which are looked up
+        # again only for changed hosts and changed DNS records.
+
+        ldap = ldap_backend(self.api)
+        cache = get_export_cache(ldap)
+        with cache['lock']:
+            changed = update_export_cache(ldap, cache, full=kw.get('full', False))
+            entries = list(cache['entries'].values())
+            if not entries:
+                raise errors.NotFound(reason=_('DHCP is not configured'))
+            dns = cache['dns']
+            unresolved = []
+            if kw.get('format') == u'kea':
+                result = u''.join(iter_kea_dhcp4(entries, dns))
+            else:
+                if cache['layout'] is None:
+                    cache['layout'] = get_dhcpd_layout(entries)
+                result = render_dhcpd_conf(
+                    cache['entries'], cache['blocks'], dns, unresolved, cache['layout'])
+            usn = cache['usn']
+        report_unresolved_names(self, unresolved)
+        return dict(
+            result=result,
+            count=len(entries),
+            changed=changed,
+            usn=usn
+        )
+
+
+class ExportEntry(dict):
+
+    # A detached copy of an LDAPEntry holding just what the renderers read,
+    # so that an export can rewrite it without touching the cached entry.
+
+    def __init__(self, dn, attrs):
+        dict.__init__(self, attrs)
+        self.dn = DN(dn)
+
+
+    @staticmethod
+    def from_entry(entry):
+        return ExportEntry(entry.dn, dict(
+            (name.lower(), [unicode(v) for v in values])
+            for (name, values) in entry.items()
+        ))
+
+
+def get_server_shards(entries, servers, dns):
+    """
+    Split the entries of cn=dhcp into the part each DHCP server needs: the
+    service with its global parameters, the subnets listed in the server's
+    dhcpSubnetDN with their pools, and the hosts whose fixed address falls
+    in one of those subnets. Hosts whose address can't be resolved through
+    dns are kept everywhere. A server without dhcpSubnetDN gets everything.
+
+    Returns a list of (server name, entries) pairs.
+    """
+    subnets = {}
+    trie = SubnetTrie()
+    common = []
+    children = {}
+    hosts = []
+
+    for entry in entries:
+        if get_dhcp_entry_type(entry) == 'dhcpsubnet':
+            network = IPNetwork(u'{0}/{1}'.format(entry['cn'][0], entry['dhcpnetmask'][0]))
+            subnets[entry.dn] = entry
+            trie.insert(network.first, network.prefixlen, entry.dn)
+
+    for entry in entries:
+        entry_type = get_dhcp_entry_type(entry)
+        if entry_type == 'dhcpservice':
+            common.append(entry)
+        elif entry_type in ('dhcppool', 'dhcphost') and entry.dn[1:] in subnets:
+            children.setdefault(entry.dn[1:], []).append(entry)
+        elif entry_type == 'dhcphost':
+            hosts.append(entry)
+
+    placed = {}
+    for host in hosts:
+        value = DHCPParameterList(host.get('dhcpstatements', [])).get('fixed-address')
+        (addresses, unresolved) = resolve_fixed_address(value or u'', dns)
+        found = set()
+        for address in addresses:
+            found.update(trie.find_containing(IPAddress(address).value))
+        if unresolved or not found:
+            common.append(host)
+        else:
+            for dn in found:
+                placed.setdefault(dn, []).append(host)
+
+    shards = []
+    for server in servers:
+        served = set(DN(dn) for dn in server.get('dhcpsubnetdn', []))
+        if not served:
+            served = set(subnets)
+        shard = list(common)
+        for dn in served:
+            if dn not in subnets:
+                continue
+            shard.append(subnets[dn])
+            shard.extend(children.get(dn, []))
+            shard.extend(placed.get(dn, []))
+        # A host in two served subnets would otherwise be declared twice.
+        seen = set()
+        shards.append((server['cn'][0], [
+            e for e in shard if not (e.dn in seen or seen.add(e.dn))
+        ]))
+    return shards
+
+
+def render_shard(shard):
+    (server, entries) = shard
+    return (server, render_dhcpd_conf(entries), len(entries))
+
+
+@register()
+class dhcpserver_export(Command):
+    __doc__ = _('Export a trimmed dhcpd.conf for each DHCP server.')
+    msg_summary = ngettext(
+        'Exported the configuration of %(count)d DHCP server',
+        'Exported the configurations of %(count)d DHCP servers', 0
+    )
+
+    takes_args = (
+        Str(
+            'cn*',
+            cli_name='hostname',
+            label=_('Hostname'),
+            doc=_('Only export the configuration of these servers.')
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Configuration per server')),
+        Output('count', int, _('Number of servers exported')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # Read the tree once, split it per server, and render the shards
+        # one after the other. Each shard is small once split, and forking
+        # the web server worker would copy its LDAP connection, Kerberos
+        # credentials and request context into every child.
+
+        ldap = ldap_backend(self.api)
+        cache = get_export_cache(ldap)
+        with cache['lock']:
+            update_export_cache(ldap, cache)
+            entries = [ExportEntry.from_entry(e) for e in cache['entries'].values()]
+            dns = dict(cache['dns'])
+        servers = [e for e in entries if get_dhcp_entry_type(e) == 'dhcpserver']
+        if args and args[0]:
+            wanted = set(args[0])
+            servers = [e for e in servers if e['cn'][0] in wanted]
+            missing = wanted - set(e['cn'][0] for e in servers)
+            if missing:
+                raise errors.NotFound(
+                    reason=_('DHCP server not found: %s') % u', '.join(sorted(missing)))
+        if not servers:
+            raise errors.NotFound(reason=_('No DHCP servers are configured'))
+
+        # Resolve the fixed addresses once for all shards, from the addresses
+        # update_export_cache keeps; the entries are private copies.
+        unresolved = []
+        for entry in entries:
+            if get_dhcp_entry_type(entry) == 'dhcphost':
+                entry['dhcpstatements'] = resolve_host_statements(entry, dns, unresolved)
+        report_unresolved_names(self, unresolved)
+
+        shards = get_server_shards(
+            [e for e in entries if get_dhcp_entry_type(e) != 'dhcpserver'],
+            servers,
+            dns
+        )
+
+        rendered = [render_shard(shard) for shard in shards]
+
+        result = [
+            dict(server=server, result=conf, count=count)
+            for (server, conf, count) in sorted(rendered)
+        ]
+        return dict(result=result, count=len(result))
+
+
+@register()
+class dhcp_check(Command):
+    __doc__ = _('Check the whole DHCP tree against the IPA hosts.')
+    msg_summary = ngettext(
+        '%(count)d DHCP problem found',
+        '%(count)d DHCP problems found', 0
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Problems found')),
+        Output('count', int, _('Number of problems found')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # Read cn=dhcp and the macaddress of every IPA host in one search
+        # each (plus one of cn=dns to resolve fixed addresses), index them
+        # by MAC, by host name and by pool range, and check everything
+        # against those indexes in a single pass.
+
+        ldap = ldap_backend(self.api)
+        entries = get_dhcp_entries(ldap, None, [
+            'objectclass', 'cn', 'dhcpnetmask', 'dhcprange',
+            'dhcphwaddress', 'dhcpstatements', 'dhcpoption'
+        ])
+        hosts = find_all_entries(
+            ldap,
+            DN(api.env.container_host, api.env.basedn),
+            '(objectclass=ipahost)',
+            ['fqdn', 'macaddress']
+        )
+        dns = get_dns_addresses(ldap)
+
+        problems = []
+
+        def problem(check, entry, error):
+            problems.append(dict(check=check, entry=entry, error=error))
+
+        host_macs = dict(
+            (h['fqdn'][0].lower(), set(normalize_macaddress(m) for m in h.get('macaddress', [])))
+            for h in hosts if 'fqdn' in h
+        )
+
+        dhcphosts = [e for e in entries if get_dhcp_entry_type(e) == 'dhcphost']
+        by_mac = {}
+        reserved = set()
+        for entry in dhcphosts:
+            macaddress = dhcphost.get_dhcphost_macaddress(entry)
+            hostname = dhcphost.get_dhcphost_hostname(entry)
+            if macaddress is not None:
+                key = normalize_macaddress(macaddress)
+                by_mac.setdefault(key, []).append(entry['cn'][0])
+                reserved.add((hostname, key))
+            if hostname is not None and hostname not in host_macs:
+                problem(u'orphan-dhcphost', entry['cn'][0],
+                        u'IPA host {0} does not exist.'.format(hostname))
+
+        for (key, cns) in sorted(by_mac.items()):
+            if len(cns) > 1:
+                for cn in sorted(cns)[1:]:
+                    problem(u'duplicate-mac', cn, u'Hardware address is also reserved by {0}.'.format(
+                        u', '.join(c for c in sorted(cns) if c != cn)))
+
+        for (hostname, keys) in sorted(host_macs.items()):
+            for key in sorted(keys):
+                if (hostname, key) not in reserved:
+                    problem(u'missing-dhcphost', hostname,
+                            u'No DHCP host for MAC address {0}.'.format(key))
+
+        index = PoolRangeIndex(get_pool_ranges(
+            [e for e in entries if get_dhcp_entry_type(e) == 'dhcppool']))
+        for entry in dhcphosts:
+            value = DHCPParameterList(entry.get('dhcpstatements', [])).get('fixed-address')
+            (addresses, unresolved) = resolve_fixed_address(value or u'', dns)
+            for address in addresses:
+                ip = IPAddress(address).value
+                found = index.find_overlap(ip, ip)
+                if found is not None:
+                    problem(u'fixed-address-in-pool', entry['cn'][0],
+                            u'Fixed address {0} is inside pool {1}.'.format(address, found[3]))
+
+        for p in find_pool_problems(entries):
+            problem(u'pool-range', p['pool'], p['error'])
+
+        return dict(result=problems, count=len(problems))
+
+
+@register()
+class dhcp_index_check(Command):
+    __doc__ = _('Report the DHCP searches that are not backed by an LDAP index.')
+    msg_summary = ngettext(
+        '%(count)d DHCP search is not indexed',
+        '%(count)d DHCP searches are not indexed', 0
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Unindexed searches')),
+        Output('count', int, _('Number of unindexed searches')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # The userRoot backend always has index entries, so finding none
+        # means they can't be read (the server hides entries the caller
+        # may not see), not that nothing is indexed.
+
+        ldap = ldap_backend(self.api)
+        try:
+            entries = ldap.get_entries(
+                index_dn,
+                ldap.SCOPE_ONELEVEL,
+                '(objectclass=nsindex)',
+                ['cn', 'nsindextype']
+            )
+        except (errors.NotFound, errors.ACIError):
+            raise errors.NotFound(reason=_(
+                'Cannot read the index configuration in %s; run the check as '
+                'a user allowed to read cn=config') % index_dn)
+
+        indexes = set()
+        for entry in entries:
+            for indextype in entry.get('nsindextype', []):
+                indexes.add((entry['cn'][0].lower(), indextype.lower()))
+
+        result = []
+        for (search, needed) in dhcp_searches:
+            missing = [u'{0} ({1})'.format(a, t) for (a, t) in needed if (a, t) not in indexes]
+            if missing:
+                result.append(dict(search=search, missing=missing))
+
+        return dict(result=result, count=len(result))
+
+
+@register()
+class dhcp_stats(Command):
+    __doc__ = _('Display timing and LDAP usage counters of the DHCP commands.')
+    msg_summary = ngettext(
+        '%(count)d DHCP command callback measured',
+        '%(count)d DHCP command callbacks measured', 0
+    )
+
+    takes_options = (
+        Flag(
+            'reset',
+            cli_name='reset',
+            label=_('Reset'),
+            doc=_('Clear the counters after displaying them.')
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Counters per command and phase')),
+        Output('count', int, _('Number of command callbacks measured')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # Counters live in the server process that handled the calls, so
+        # they only cover the requests this process served.
+
+        def percentile(samples, p):
+            return samples[min(int(len(samples) * p / 100.0), len(samples) - 1)] * 1000
+
+        with command_stats_lock:
+            stats = [(k, dict(v, samples=sorted(v['samples']))) for (k, v) in command_stats.items()]
+            if kw.get('reset'):
+                command_stats.clear()
+
+        result = []
+        for ((name, phase), s) in sorted(stats):
+            result.append(dict(
+                command=unicode(name),
+                phase=unicode(phase),
+                calls=s['calls'],
+                reads=s['reads'],
+                writes=s['writes'],
+                entries=s['entries'],
+                total_ms=s['elapsed'] * 1000,
+                p50_ms=percentile(s['samples'], 50),
+                p95_ms=percentile(s['samples'], 95),
+                p99_ms=percentile(s['samples'], 99),
+            ))
+
+        return dict(result=result, count=len(result))
+
+
+# The attributes dhcp_apply manages on each kind of entry. Anything else
+# on an existing entry, and any of these a document item leaves out, is
+# left alone.
+changeset_attrs = {
+    'dhcpservice': ('dhcpstatements', 'dhcpoption', 'dhcpcomments'),
+    'dhcpsubnet': ('dhcpnetmask', 'dhcpstatements', 'dhcpoption', 'dhcpcomments'),
+    'dhcppool': ('dhcprange', 'dhcppermitlist', 'dhcpstatements', 'dhcpoption', 'dhcpcomments'),
+    'dhcphost': ('dhcphwaddress', 'dhcpstatements', 'dhcpoption', 'dhcpcomments'),
+}
+
+
+def parse_changeset(ldap, data):
+    """
+    Turn a dhcp_apply document into the entries it describes, as an ordered
+    map from DN to (entry type, attributes). Every problem in the document
+    is collected and raised together as one ValidationError.
+    """
+    try:
+        doc = json.loads(data)
+    except ValueError as e:
+        raise errors.ValidationError(name='data', error=unicode(e))
+    if not isinstance(doc, dict):
+        raise errors.ValidationError(name='data', error=_('Expected a JSON object.'))
+
+    base_dn = DN(container_dn, api.env.basedn)
+    desired = collections.OrderedDict()
+    problems = []
+
+    def values(item, attr):
+        value = item.get(attr)
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            value = [value]
+        return [unicode(v) for v in value]
+
+    def check_keys(item, where, allowed):
+        if not isinstance(item, dict):
+            problems.append(u'{0}: expected an object'.format(where))
+            return False
+        unknown = sorted(set(item) - set(allowed))
+        if unknown:
+            problems.append(u'{0}: unknown keys {1}'.format(where, u', '.join(unknown)))
+        return True
+
+    def check_list(items, where):
+        if not isinstance(items, list):
+            problems.append(u'{0}: expected a list'.format(where))
+            return []
+        return items
+
+    def add(dn, entry_type, attrs):
+        if dn in desired:
+            problems.append(u'{0}: listed twice'.format(dn))
+        attrs['objectclass'] = ['top'] + api.Object[entry_type].object_class
+        desired[dn] = (entry_type, attrs)
+
+    unknown = sorted(set(doc) - set(['service', 'subnets', 'hosts']))
+    if unknown:
+        problems.append(u'unknown sections {0}'.format(u', '.join(unknown)))
+
+    if 'service' in doc and check_keys(doc['service'], u'service', changeset_attrs['dhcpservice']):
+        add(base_dn, 'dhcpservice', dict(
+            (a, values(doc['service'], a)) for a in changeset_attrs['dhcpservice']
+            if a in doc['service']))
+
+    trie = SubnetTrie()
+    for (i, item) in enumerate(check_list(doc.get('subnets', []), u'subnets'), 1):
+        where = u'subnet {0}'.format(i)
+        if not check_keys(item, where, ('cn', 'pools') + changeset_attrs['dhcpsubnet']):
+            continue
+        try:
+            network = IPNetwork(u'{0}/{1}'.format(item['cn'], int(item['dhcpnetmask'])))
+        except (KeyError, ValueError, TypeError, AddrFormatError) as e:
+            problems.append(u'{0}: cn and dhcpnetmask must give a network: {1}'.format(where, e))
+            continue
+        if unicode(network.network) != unicode(item['cn']):
+            problems.append(u'{0}: {1} is not the network address of {2}'.format(
+                where, item['cn'], network.cidr))
+            continue
+        overlapping = trie.find_overlapping(network.first, network.prefixlen)
+        if overlapping:
+            problems.append(u'{0}: {1} overlaps {2}'.format(where, network.cidr, overlapping[0]))
+        trie.insert(network.first, network.prefixlen, unicode(network.cidr))
+
+        subnet_dn = DN(('cn', unicode(network.network)), base_dn)
+        attrs = dict((a, values(item, a)) for a in changeset_attrs['dhcpsubnet'] if a in item)
+        attrs['cn'] = [unicode(network.network)]
+        attrs['dhcpnetmask'] = [unicode(network.prefixlen)]
+        add(subnet_dn, 'dhcpsubnet', attrs)
+
+        for (j, pool) in enumerate(check_list(item.get('pools') or [], u'{0} pools'.format(where)), 1):
+            pool_where = u'{0} pool {1}'.format(where, j)
+            if not check_keys(pool, pool_where, ('cn',) + changeset_attrs['dhcppool']):
+                continue
+            attrs = dict((a, values(pool, a)) for a in changeset_attrs['dhcppool'] if a in pool)
+            if len(attrs.get('dhcprange', [])) != 1:
+                problems.append(u'{0}: expected one dhcprange'.format(pool_where))
+                continue
+            attrs['cn'] = [unicode(pool.get('cn') or attrs['dhcprange'][0])]
+            add(DN(('cn', attrs['cn'][0]), subnet_dn), 'dhcppool', attrs)
+
+    macaddress_re = re.compile(macaddress_pattern)
+    owners = {}
+    for (i, item) in enumerate(check_list(doc.get('hosts', []), u'hosts'), 1):
+        where = u'host {0}'.format(i)
+        if not check_keys(item, where, ('hostname', 'macaddress', 'dhcpcomments')):
+            continue
+        if not item.get('hostname') or not item.get('macaddress'):
+            problems.append(u'{0}: expected hostname and macaddress'.format(where))
+            continue
+        macaddress = normalize_macaddress(unicode(item['macaddress']))
+        if not macaddress_re.match(macaddress):
+            problems.append(u'{0}: {1}: {2}'.format(where, macaddress, macaddress_errmsg))
+            continue
+        if macaddress in owners:
+            problems.append(u'{0}: {1} is already reserved by {2}'.format(
+                where, macaddress, owners[macaddress]))
+            continue
+        owners[macaddress] = item['hostname']
+        entry = dhcphost.make_dhcphost_entry(ldap, unicode(item['hostname']), macaddress)
+        attrs = dict((a, list(entry.get(a, []))) for a in changeset_attrs['dhcphost'])
+        attrs['cn'] = list(entry['cn'])
+        if 'dhcpcomments' in item:
+            attrs['dhcpcomments'] = values(item, 'dhcpcomments')
+        add(entry.dn, 'dhcphost', attrs)
+
+    for p in find_pool_problems([ExportEntry(dn, attrs) for (dn, (t, attrs)) in desired.items()]):
+        problems.append(u'pool {0}: {1}'.format(p['pool'], p['error']))
+
+    if problems:
+        raise errors.ValidationError(name='data', error=u'; '.join(problems))
+    return (doc, desired)
+
+
+def add_changeset_defaults(entry_type, attrs, new, service_statements):
+
+    # What dhcpsubnet_add and dhcppool_add would store for a document item:
+    # a subnet's mask and broadcast options, a pool's permit list, and the
+    # lease times a pool inherits from the service, each unless given. On
+    # an existing entry only the attributes the item sets are completed,
+    # since the others are left as they are.
+
+    attrs = dict(attrs)
+    if entry_type == 'dhcpsubnet' and (new or 'dhcpoption' in attrs):
+        network = IPNetwork(u'{0}/{1}'.format(attrs['cn'][0], attrs['dhcpnetmask'][0]))
+        options = DHCPParameterList(attrs.get('dhcpoption', []))
+        if options.get('subnet-mask') is None:
+            options.set('subnet-mask', unicode(network.netmask))
+        if options.get('broadcast-address') is None:
+            options.set('broadcast-address', unicode(network.broadcast))
+        attrs['dhcpoption'] = options.serialize()
+    elif entry_type == 'dhcppool':
+        if new and 'dhcppermitlist' not in attrs:
+            attrs['dhcppermitlist'] = [u'allow unknown-clients', u'allow known-clients']
+        if new or 'dhcpstatements' in attrs:
+            statements = DHCPParameterList(attrs.get('dhcpstatements', []))
+            config = DHCPParameterList(service_statements)
+            for (name, attr, keyword, decode, encode) in lease_time_params:
+                if statements.get(keyword) is None and config.get(keyword) is not None:
+                    statements.set(keyword, config.get(keyword))
+            attrs['dhcpstatements'] = statements.serialize()
+    return attrs
+
+
+def plan_changeset(doc, desired, existing):
+
+    # Compare the desired entries with the current ones and return the
+    # steps to get from one to the other: deletes deepest first, then
+    # modifications of only the attributes that differ, then adds
+    # shallowest first. A section left out of the document is left alone;
+    # a section that is there describes everything of its kind. Within an
+    # entry, attributes the document doesn't set are left alone too.
+
+    managed = set()
+    if 'subnets' in doc:
+        managed.update(['dhcpsubnet', 'dhcppool'])
+    if 'hosts' in doc:
+        managed.add('dhcphost')
+
+    deletes = []
+    for (dn, entry) in existing.items():
+        entry_type = get_dhcp_entry_type(entry)
+        if entry_type in managed and dn not in desired:
+            deletes.append((u'delete', dn, entry_type, {}))
+    deletes.sort(key=lambda step: -len(step[1]))
+
+    base_dn = DN(container_dn, api.env.basedn)
+    service_statements = desired.get(base_dn, (None, {}))[1].get('dhcpstatements')
+    if service_statements is None and base_dn in existing:
+        service_statements = existing[base_dn].get('dhcpstatements', [])
+
+    modifies = []
+    adds = []
+    for (dn, (entry_type, attrs)) in desired.items():
+        entry = existing.get(dn)
+        attrs = add_changeset_defaults(
+            entry_type, attrs, entry is None, service_statements or [])
+        if entry is None:
+            if entry_type == 'dhcpservice':
+                raise errors.NotFound(reason=_('DHCP is not configured'))
+            adds.append((u'add', dn, entry_type, dict(
+                (attr, value) for (attr, value) in attrs.items() if value)))
+            continue
+        changed = {}
+        for attr in changeset_attrs[entry_type]:
+            if attr not in attrs:
+                continue
+            have = sorted(unicode(v) for v in entry.get(attr, []))
+            if sorted(attrs[attr]) != have:
+                changed[attr] = attrs[attr]
+        if changed:
+            modifies.append((u'modify', dn, entry_type, changed))
+    adds.sort(key=lambda step: len(step[1]))
+
+    return deletes + modifies + adds
+
+
+def apply_changeset(ldap, plan, existing):
+
+    # One LDAP operation per entry. Every step that succeeds records how to
+    # undo it; if a later one fails, the recorded steps are undone in
+    # reverse order and the original error is raised.
+
+    undo = []
+    try:
+        for (action, dn, entry_type, attrs) in plan:
+            if action == u'delete':
+                ldap.delete_entry(dn)
+                undo.append((u'add', dn, dict(existing[dn])))
+            elif action == u'modify':
+                entry = existing[dn]
+                before = dict((a, list(entry.get(a, []))) for a in attrs)
+                for (attr, value) in attrs.items():
+                    entry[attr] = value
+                ldap.update_entry(entry)
+                undo.append((u'modify', dn, before))
+            else:
+                ldap.add_entry(ldap.make_entry(dn, attrs))
+                undo.append((u'delete', dn, None))
+    except errors.ExecutionError:
+        rollback_changeset(ldap, undo)
+        raise
+    finally:
+        dhcpservice.invalidate_cached_entry()
+
+
+def rollback_changeset(ldap, undo):
+    for (action, dn, attrs) in reversed(undo):
+        try:
+            if action == u'add':
+                ldap.add_entry(ldap.make_entry(dn, attrs))
+            elif action == u'modify':
+                entry = ldap.get_entry(dn, list(attrs))
+                for (attr, value) in attrs.items():
+                    entry[attr] = value
+                ldap.update_entry(entry)
+            else:
+                ldap.delete_entry(dn)
+        except errors.ExecutionError as e:
+            logger.error('dhcp: could not roll back %s of %s: %s', action, dn, e)
+
+
+@register()
+class dhcp_apply(Command):
+    __doc__ = _('Bring the DHCP tree to the state described by a JSON document.')
+    msg_summary = ngettext(
+        'Applied %(count)d DHCP change',
+        'Applied %(count)d DHCP changes', 0
+    )
+
+    takes_args = (
+        File(
+            'data',
+            cli_name='file',
+            label=_('Desired State'),
+            doc=_('JSON object with optional "service", "subnets" (each with '
+                  '"pools") and "hosts" sections. Each section given replaces '
+                  'everything of its kind.')
+        ),
+    )
+
+    takes_options = (
+        Flag(
+            'dry_run',
+            cli_name='dry_run',
+            label=_('Dry Run'),
+            doc=_('Only report the changes that would be made.')
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        Output('result', (list, tuple), _('Changes, in the order they are applied')),
+        Output('count', int, _('Number of changes')),
+    )
+
+    def execute(self, *args, **kw):
+
+        # One read of the whole tree, one plan, and only then any writes,
+        # so that a document that doesn't validate changes nothing and one
+        # that fails halfway is rolled back.
+
+        ldap = ldap_backend(self.api)
+        (doc, desired) = parse_changeset(ldap, args[0])
+        existing = dict((e.dn, e) for e in get_dhcp_entries(ldap, None, ['*']))
+        plan = plan_changeset(doc, desired, existing)
+
+        result = [
+            dict(
+                action=action,
+                dn=dn,
+                type=unicode(entry_type),
+                attributes=sorted(a for a in attrs if a != 'objectclass')
+            )
+            for (action, dn, entry_type, attrs) in plan
+        ]
+
+        if kw.get('dry_run'):
+            return dict(
+                result=result,
+                count=len(result),
+                summary=ngettext(
+                    'Would apply %(count)d DHCP change',
+                    'Would apply %(count)d DHCP changes', len(result)
+                ) % dict(count=len(result))
+            )
+
+        apply_changeset(ldap, plan, existing)
+        return dict(result=result, count=len(result))
+
+
 ###############################################################################
 
 
 from . import host
 
 
+class DHCPHostsFailed(messages.PublicMessage):
+    """
+    **13100** The host entry was written but some of its DHCP hosts were not.
+    """
+
+    errno = 13100
+    type = 'warning'
+    format = _('Could not %(action)s DHCP hosts of "%(host)s": %(reasons)s')
+
+
+def report_dhcphost_failures(command, hostname, action, results):
+
+    # The host entry itself has already been written by the time the hooks
+    # run, so a dhcpHost that couldn't be handled is a warning on the host
+    # command rather than an error that would hide that.
+
+    failed = [r for r in results if r['status'] == u'failed']
+    if not failed:
+        return
+    reasons = u', '.join(
+        u'{0} ({1})'.format(r['macaddress'], r['error']) for r in failed)
+    logger.warning('dhcp: could not %s DHCP hosts of %s: %s', action, hostname, reasons)
+    command.add_message(DHCPHostsFailed(action=action, host=hostname, reasons=reasons))
+
+
 def host_add_dhcphost(self, ldap, dn, entry_attrs, *keys, **options):
-    if 'macaddress' in entry_attrs:
-        for addr in entry_attrs['macaddress']:
-            api.Command['dhcphost_add'](entry_attrs['fqdn'][0], addr)
+    if 'macaddress' not in entry_attrs:
+        return dn
+
+    # Check every address once, then create all the dhcpHost entries in a
+    # single pass; an address that fails doesn't stop the others.
+
+    hostname = entry_attrs['fqdn'][0]
+    macaddress_re = re.compile(macaddress_pattern)
+    rows = []
+    results = []
+    seen = set()
+    for macaddress in entry_attrs['macaddress']:
+        macaddress = normalize_macaddress(macaddress)
+        if not macaddress_re.match(macaddress):
+            results.append(dict(
+                hostname=hostname,
+                macaddress=macaddress,
+                status=u'failed',
+                error=unicode(macaddress_errmsg)
+            ))
+            continue
+        if macaddress in seen:
+            continue
+        seen.add(macaddress)
+        rows.append((hostname, macaddress))
+
+    results.extend(dhcphost.add_dhcphost_entries(ldap, rows))
+    report_dhcphost_failures(self, hostname, u'add', results)
     return dn
 
-host.host_add.register_post_callback(host_add_dhcphost)
+host.host_add.register_post_callback(
+    instrumented('host_add_dhcphost', 'post', host_add_dhcphost))
 
 
 def host_mod_dhcphost(self, ldap, dn, entry_attrs, *keys, **options):
@@ -1251,51 +4314,30 @@ def host_mod_dhcphost(self, ldap, dn, entry_attrs, *keys, **options):
     else:
         macaddresses = list(options['macaddress'])
 
-    filter = ldap.make_filter(
-        {
-            'cn': entry_attrs['fqdn'][0]
-        },
-        exact=False,
-        leading_wildcard=False,
-        trailing_wildcard=True
-    )
-
-    entries = []
-    try:
-        entries = ldap.get_entries(
-            DN(container_dn, api.env.basedn),
-            ldap.SCOPE_SUBTREE,
-            filter
-        )
-    except errors.NotFound:
-        pass
-
-    for entry in entries:
-        entry_macaddr = entry['dhcpHWAddress'][0].replace('ethernet ', '')
-        if entry_macaddr not in macaddresses:
-            api.Command['dhcphost_del'](entry_attrs['fqdn'][0], entry_macaddr)
-        if entry_macaddr in macaddresses:
-            macaddresses.remove(entry_macaddr)
-
-    for new_macaddr in macaddresses:
-        api.Command['dhcphost_add'](entry_attrs['fqdn'][0], new_macaddr)
+    results = dhcphost.sync_dhcphost_entries(ldap, entry_attrs['fqdn'][0], macaddresses)
+    report_dhcphost_failures(self, entry_attrs['fqdn'][0], u'update', results)
 
     return dn
 
-host.host_mod.register_post_callback(host_mod_dhcphost)
+host.host_mod.register_post_callback(
+    instrumented('host_mod_dhcphost', 'post', host_mod_dhcphost))
 
 
 def host_del_dhcphost(self, ldap, dn, *keys, **options):
 
-    entry = ldap.get_entry(dn)
+    # Go by the hostname rather than the host's current macaddress values,
+    # so entries left behind by an address that was since changed or
+    # spelled differently are cleaned up as well.
 
-    if 'macaddress' in entry:
-        for addr in entry['macaddress']:
-            try:
-                api.Command['dhcphost_del'](entry['fqdn'][0], addr)
-            except:
-                pass
+    hostname = dn['fqdn']
+    entries = dhcphost.find_dhcphost_entries(ldap, hostname)
+    results = dhcphost.delete_dhcphost_entries(ldap, hostname, entries)
+    report_dhcphost_failures(self, hostname, u'remove', results)
 
     return dn
 
-host.host_del.register_pre_callback(host_del_dhcphost)
+host.host_del.register_pre_callback(
+    instrumented('host_del_dhcphost', 'pre', host_del_dhcphost))
+
+
+instrument_commands(globals())
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Jeffery Harrell <jefferyharrell@gmail.com>
+# See file 'LICENSE' for use and warranty information.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helpers of the DHCP plugin that need nothing but the standard library:
+the subnet and pool range indexes, the dhcpd.leases parser, MAC address
+normalization and Kea subnet ids. They are kept out of dhcp.py so they
+can be used and tested without IPA.
+"""
+
+
+#### Imports ##################################################################
+
+
+import bisect
+import calendar
+import datetime
+import re
+
+
+#### indexes ##################################################################
+
+
+class SubnetTrie(object):
+
+    # Binary prefix trie over IPv4 subnets. Each node is a two-slot list of
+    # children plus the subnets whose prefix ends there, so containment,
+    # longest-prefix and overlap queries walk at most 32 levels no matter
+    # how many subnets are indexed.
+
+    def __init__(self):
+        self.root = [None, None, []]
+
+
+    def insert(self, network, prefixlen, value):
+        node = self.root
+        for bit in SubnetTrie.bits(network, prefixlen):
+            if node[bit] is None:
+                node[bit] = [None, None, []]
+            node = node[bit]
+        node[2].append(value)
+
+
+    @staticmethod
+    def bits(address, prefixlen):
+        for i in range(prefixlen):
+            yield (address >> (31 - i)) & 1
+
+
+    def find_containing(self, network, prefixlen=32):
+
+        # Every subnet containing network/prefixlen, shortest prefix first,
+        # so the last one is the longest-prefix match.
+
+        found = list(self.root[2])
+        node = self.root
+        for bit in SubnetTrie.bits(network, prefixlen):
+            node = node[bit]
+            if node is None:
+                break
+            found.extend(node[2])
+        return found
+
+
+    def find_overlapping(self, network, prefixlen):
+
+        # Subnets containing network/prefixlen plus every subnet inside it.
+
+        found = list(self.root[2])
+        node = self.root
+        for bit in SubnetTrie.bits(network, prefixlen):
+            node = node[bit]
+            if node is None:
+                return found
+            found.extend(node[2])
+        found = found[:len(found) - len(node[2])]
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            found.extend(node[2])
+            stack.extend(c for c in node[:2] if c is not None)
+        return found
+
+
+class PoolRangeIndex(object):
+
+    # Sorted interval index over dhcpRange values. Ranges are kept ordered by
+    # their first address together with the running maximum of their last
+    # addresses, so asking whether a new range overlaps any indexed one is a
+    # single bisect no matter how many pools the subnet has.
+
+    def __init__(self, ranges):
+        self.ranges = sorted(ranges)
+        self.starts = [r[0] for r in self.ranges]
+        self.maxends = []
+        widest = None
+        for r in self.ranges:
+            if widest is None or r[1] > widest[1]:
+                widest = r
+            self.maxends.append(widest)
+
+
+    def find_overlap(self, start, end):
+        i = bisect.bisect_right(self.starts, end)
+        if i > 0 and self.maxends[i - 1][1] >= start:
+            return self.maxends[i - 1]
+        return None
+
+
+    def find_overlaps(self):
+        overlaps = []
+        widest = None
+        for r in self.ranges:
+            if widest is not None and r[0] <= widest[1]:
+                overlaps.append((widest, r))
+            if widest is None or r[1] > widest[1]:
+                widest = r
+        return overlaps
+
+
+#### dhcpd.leases #############################################################
+
+
+def parse_lease_time(value):
+
+    # "4 2016/10/06 17:41:51", "epoch 1475775711" or "never"; times in
+    # dhcpd.leases are UTC. Returns seconds since the epoch, or None for
+    # never.
+
+    parts = value.split()
+    if not parts or parts[0] == 'never':
+        return None
+    if parts[0] == 'epoch':
+        return int(parts[1])
+    when = datetime.datetime.strptime(u' '.join(parts[1:3]), '%Y/%m/%d %H:%M:%S')
+    return calendar.timegm(when.timetuple())
+
+
+def iter_text_lines(text):
+
+    # The lines of text one at a time, without building a list of them.
+
+    start = 0
+    while start < len(text):
+        end = text.find(u'\n', start)
+        if end < 0:
+            end = len(text)
+        yield text[start:end]
+        start = end + 1
+
+
+def iter_dhcpd_leases(lines):
+    """
+    Parse dhcpd.leases from an iterable of lines, yielding one dict per
+    lease declaration with the keys address, state, ends and hwaddress.
+    Only the declaration being read is kept in memory.
+    """
+    lease = None
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        if lease is None:
+            if line.startswith('lease ') and line.endswith('{'):
+                lease = dict(address=line.split()[1], state=None, ends=None, hwaddress=None)
+            continue
+        if line == '}':
+            yield lease
+            lease = None
+            continue
+        line = line.rstrip(';')
+        if line.startswith('binding state '):
+            lease['state'] = line.split()[-1]
+        elif line.startswith('ends '):
+            try:
+                lease['ends'] = parse_lease_time(line[len('ends '):])
+            except (ValueError, IndexError):
+                pass
+        elif line.startswith('hardware '):
+            lease['hwaddress'] = line.split()[-1].upper()
+
+
+#### MAC addresses ############################################################
+
+
+def normalize_macaddress(value):
+
+    # The one form MAC addresses are stored and compared in: upper case and
+    # colon separated. Anything that isn't a MAC address comes back as it
+    # was, for the pattern check to reject.
+
+    digits = re.sub(r'[:|\-]', '', value.strip()).upper()
+    if not re.match(r'^[0-9A-F]{12}$', digits):
+        return value
+    return u':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+#### Kea ######################################################################
+
+
+kea_subnet_id_max = 2 ** 32 - 2
+
+
+def get_kea_subnet_ids(networks):
+
+    # Map each network to a Kea subnet id. The id is the network address,
+    # which is stable across exports, so Kea keeps matching existing
+    # leases to the subnet. Kea reserves 0 and 2^32 - 1, so a network whose
+    # address is one of those, or is already taken, gets the next free id
+    # after it once every other network has its own.
+
+    ids = {}
+    taken = set()
+    later = []
+    for network in networks:
+        if 1 <= network.first <= kea_subnet_id_max and network.first not in taken:
+            ids[network] = network.first
+            taken.add(network.first)
+        else:
+            later.append(network)
+    for network in later:
+        candidate = network.first
+        while candidate < 1 or candidate > kea_subnet_id_max or candidate in taken:
+            candidate = candidate + 1 if candidate < kea_subnet_id_max else 1
+        ids[network] = candidate
+        taken.add(candidate)
+    return ids
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Jeffery Harrell <jefferyharrell@gmail.com>
+# See file 'LICENSE' for use and warranty information.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Unit tests for the parts of the DHCP plugin that need IPA but not LDAP.
+Run them on an IPA server with the plugin installed:
+
+    python -m pytest tests
+
+The helpers that need nothing but the standard library are tested in
+test_dhcputil.py, which runs anywhere.
+"""
+
+
+#### Imports ##################################################################
+
+
+import json
+
+import pytest
+
+pytest.importorskip('ipalib')
+
+from ipalib import api, errors
+from ipapython.dn import DN
+
+if not api.isdone('finalize'):
+    api.bootstrap(context='test', in_server=True)
+    api.finalize()
+
+from ipaserver.plugins import dhcp
+
+
+#### Helpers ##################################################################
+
+
+def make_entry(dn, **attrs):
+    return dhcp.ExportEntry(dn, dict(
+        (name, [unicode(v) for v in values]) for (name, values) in attrs.items()))
+
+
+base_dn = DN(dhcp.container_dn, api.env.basedn)
+subnet_dn = DN(('cn', '10.0.0.0'), base_dn)
+pool_dn = DN(('cn', '10.0.0.100 10.0.0.200'), subnet_dn)
+
+
+def existing_tree():
+
+    # cn=dhcp as dhcpsubnet_add and dhcppool_add leave it.
+
+    entries = [
+        make_entry(
+            base_dn,
+            objectclass=['top', 'dhcpservice'],
+            dhcpstatements=['authoritative', 'default-lease-time 43200', 'max-lease-time 86400']),
+        make_entry(
+            subnet_dn,
+            objectclass=['top', 'dhcpsubnet'],
+            cn=['10.0.0.0'],
+            dhcpnetmask=['24'],
+            dhcpoption=[
+                'subnet-mask 255.255.255.0', 'broadcast-address 10.0.0.255',
+                'routers 10.0.0.1']),
+        make_entry(
+            pool_dn,
+            objectclass=['top', 'dhcppool'],
+            cn=['10.0.0.100 10.0.0.200'],
+            dhcprange=['10.0.0.100 10.0.0.200'],
+            dhcppermitlist=['allow unknown-clients', 'allow known-clients'],
+            dhcpstatements=['default-lease-time 43200', 'max-lease-time 86400']),
+    ]
+    return dict((e.dn, e) for e in entries)
+
+
+def address(value):
+    return dhcp.IPAddress(value).value
+
+
+def plan(doc, existing=None):
+    (doc, desired) = dhcp.parse_changeset(None, json.dumps(doc))
+    if existing is None:
+        existing = existing_tree()
+    return dhcp.plan_changeset(doc, desired, existing)
+
+
+#### plan_changeset ###########################################################
+
+
+@pytest.mark.parametrize('doc', [
+    {'subnets': [
+        {'cn': '10.0.0.0', 'dhcpnetmask': 24,
+         'pools': [{'dhcprange': '10.0.0.100 10.0.0.200'}]}]},
+    {'subnets': [
+        {'cn': '10.0.0.0', 'dhcpnetmask': 24, 'dhcpoption': ['routers 10.0.0.1'],
+         'pools': [{'dhcprange': '10.0.0.100 10.0.0.200', 'dhcpstatements': []}]}]},
+    {'service': {
+        'dhcpstatements': ['authoritative', 'default-lease-time 43200', 'max-lease-time 86400']},
+     'subnets': [
+        {'cn': '10.0.0.0', 'dhcpnetmask': 24,
+         'pools': [{'cn': '10.0.0.100 10.0.0.200', 'dhcprange': '10.0.0.100 10.0.0.200'}]}]},
+    {},
+])
+def test_plan_unchanged_tree(doc):
+    assert plan(doc) == []
+
+
+def test_plan_modifies_only_changed_attributes():
+    steps = plan({'subnets': [
+        {'cn': '10.0.0.0', 'dhcpnetmask': 24, 'dhcpoption': ['routers 10.0.0.254'],
+         'pools': [{'dhcprange': '10.0.0.100 10.0.0.200'}]}]})
+    assert len(steps) == 1
+    (action, dn, entry_type, attrs) = steps[0]
+    assert (action, dn, entry_type) == (u'modify', subnet_dn, 'dhcpsubnet')
+    assert sorted(attrs['dhcpoption']) == sorted([
+        u'subnet-mask 255.255.255.0', u'broadcast-address 10.0.0.255', u'routers 10.0.0.254'])
+
+
+def test_plan_new_entries_get_add_defaults():
+    steps = plan({'subnets': [
+        {'cn': '10.0.0.0', 'dhcpnetmask': 24,
+         'pools': [{'dhcprange': '10.0.0.100 10.0.0.200'}]},
+        {'cn': '10.1.0.0', 'dhcpnetmask': 16,
+         'pools': [{'dhcprange': '10.1.0.10 10.1.0.20'}]}]})
+    assert [(s[0], s[2]) for s in steps] == [(u'add', 'dhcpsubnet'), (u'add', 'dhcppool')]
+    subnet = steps[0][3]
+    assert sorted(subnet['dhcpoption']) == [
+        u'broadcast-address 10.1.255.255', u'subnet-mask 255.255.0.0']
+    pool = steps[1][3]
+    assert sorted(pool['dhcppermitlist']) == [u'allow known-clients', u'allow unknown-clients']
+    assert sorted(pool['dhcpstatements']) == [u'default-lease-time 43200', u'max-lease-time 86400']
+
+
+def test_plan_deletes_children_first():
+    steps = plan({'subnets': []})
+    assert [(s[0], s[1]) for s in steps] == [(u'delete', pool_dn), (u'delete', subnet_dn)]
+
+
+@pytest.mark.parametrize('doc', [
+    {'subnet': []},
+    {'subnets': [{'cn': '10.0.0.1', 'dhcpnetmask': 24}]},
+    {'subnets': [{'cn': '10.0.0.0', 'dhcpnetmask': 24}, {'cn': '10.0.0.0', 'dhcpnetmask': 16}]},
+    {'subnets': [{'cn': '10.0.0.0', 'dhcpnetmask': 24,
+                  'pools': [{'dhcprange': '10.0.1.1 10.0.1.9'}]}]},
+    {'hosts': [{'hostname': 'a.example.com', 'macaddress': 'zz'}]},
+    {'subnets': 5},
+    {'subnets': '10.0.0.0'},
+    {'subnets': None},
+    {'hosts': {'hostname': 'a.example.com'}},
+    {'subnets': [{'cn': '10.0.0.0', 'dhcpnetmask': 24, 'pools': 'abc'}]},
+])
+def test_parse_rejects_invalid_documents(doc):
+    with pytest.raises(errors.ValidationError):
+        plan(doc)
+
+
+#### check_pool_ranges ########################################################
+
+
+def make_index(*dhcpranges):
+    return dhcp.PoolRangeIndex(dhcp.get_pool_ranges([
+        make_entry(DN(('cn', r), subnet_dn), cn=[r], dhcprange=[r]) for r in dhcpranges]))
+
+
+@pytest.mark.parametrize(('dhcpranges', 'error'), [
+    (['10.0.0.10 10.0.0.20'], None),
+    (['10.0.0.10 10.0.0.20', '10.0.0.30 10.0.0.40'], None),
+    (['10.0.0.10'], 'Range must be of the form'),
+    (['10.0.0.20 10.0.0.10'], 'First IP must come before last IP'),
+    (['10.0.0.250 10.0.1.10'], 'is outside parent subnet 10.0.0.0/24'),
+    (['10.0.0.150 10.0.0.160'], 'overlaps range 10.0.0.100 10.0.0.200 of pool'),
+    (['10.0.0.10 10.0.0.20', '10.0.0.15 10.0.0.25'], 'overlaps range 10.0.0.10 10.0.0.20.'),
+])
+def test_check_pool_ranges(dhcpranges, error):
+    subnet = {'cn': [u'10.0.0.0'], 'dhcpNetMask': [u'24']}
+    found = dhcp.check_pool_ranges(subnet, dhcpranges, make_index('10.0.0.100 10.0.0.200'))
+    if error is None:
+        assert found is None
+    else:
+        assert error in found
+
+
+#### iter_kea_dhcp4 ###########################################################
+
+
+def kea(entries, dns=None):
+    return json.loads(u''.join(dhcp.iter_kea_dhcp4(entries, dns or {})))['Dhcp4']
+
+
+def test_kea_subnets_pools_and_lifetimes():
+    config = kea(existing_tree().values())
+    assert config['valid-lifetime'] == 43200
+    assert config['max-valid-lifetime'] == 86400
+    (subnet,) = config['subnet4']
+    assert subnet['id'] == address('10.0.0.0')
+    assert subnet['subnet'] == '10.0.0.0/24'
+    assert [p['pool'] for p in subnet['pools']] == ['10.0.0.100 - 10.0.0.200']
+    assert subnet['reservations'] == []
+    assert [o['name'] for o in subnet['option-data']] == [
+        'subnet-mask', 'broadcast-address', 'routers']
+
+
+def test_kea_subnet_id_is_never_zero():
+    entries = [make_entry(
+        DN(('cn', '0.0.0.0'), base_dn),
+        objectclass=['top', 'dhcpsubnet'], cn=['0.0.0.0'], dhcpnetmask=['0'])]
+    assert [s['id'] for s in kea(entries)['subnet4']] == [1]
+
+
+@pytest.mark.parametrize(('fixed', 'dns', 'placed', 'address'), [
+    ('10.0.0.5', {}, '10.0.0.0/24', '10.0.0.5'),
+    ('web.example.com', {u'web.example.com': [u'10.0.0.6']}, '10.0.0.0/24', '10.0.0.6'),
+    ('192.168.0.5', {}, None, None),
+    ('missing.example.com', {}, None, None),
+])
+def test_kea_reservations(fixed, dns, placed, address):
+    entries = list(existing_tree().values()) + [make_entry(
+        DN(('cn', 'web'), base_dn),
+        objectclass=['top', 'dhcphost'], cn=['web'],
+        dhcphwaddress=['ethernet 00:1A:2B:3C:4D:5E'],
+        dhcpstatements=['fixed-address {0}'.format(fixed)])]
+    config = kea(entries, dns)
+    if placed is None:
+        (reservation,) = config['reservations']
+        assert config['reservations-global'] is True
+    else:
+        (reservation,) = [s for s in config['subnet4'] if s['subnet'] == placed][0]['reservations']
+        assert 'reservations' not in config
+    assert reservation['hw-address'] == '00:1a:2b:3c:4d:5e'
+    assert reservation.get('ip-address') == address
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016 Jeffery Harrell <jefferyharrell@gmail.com>
+# See file 'LICENSE' for use and warranty information.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Unit tests for ipaserver/dhcputil.py. It needs nothing but the standard
+library, so these run anywhere, IPA or not:
+
+    python -m pytest tests
+"""
+
+
+#### Imports ##################################################################
+
+
+import os
+import socket
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ipaserver'))
+
+import dhcputil
+
+
+#### Helpers ##################################################################
+
+
+def address(value):
+    return struct.unpack('!I', socket.inet_aton(value))[0]
+
+
+class Network(object):
+
+    # The two attributes of a netaddr IPNetwork the helpers use.
+
+    def __init__(self, cidr):
+        (value, prefixlen) = cidr.split('/')
+        self.prefixlen = int(prefixlen)
+        self.first = address(value)
+
+
+def make_trie(*cidrs):
+    trie = dhcputil.SubnetTrie()
+    for cidr in cidrs:
+        network = Network(cidr)
+        trie.insert(network.first, network.prefixlen, cidr)
+    return trie
+
+
+def make_index(*dhcpranges):
+    ranges = []
+    for dhcprange in dhcpranges:
+        (start, end) = dhcprange.split()
+        ranges.append((address(start), address(end), u'pool', dhcprange))
+    return dhcputil.PoolRangeIndex(ranges)
+
+
+#### SubnetTrie ###############################################################
+
+
+@pytest.mark.parametrize(('cidrs', 'query', 'expected'), [
+    (['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24'], '10.1.2.3', ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24']),
+    (['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24'], '10.2.0.1', ['10.0.0.0/8']),
+    (['10.0.0.0/8'], '192.168.0.1', []),
+    (['0.0.0.0/0', '10.0.0.0/8'], '192.168.0.1', ['0.0.0.0/0']),
+    (['10.0.0.4/30'], '10.0.0.7', ['10.0.0.4/30']),
+    (['10.0.0.4/30'], '10.0.0.8', []),
+])
+def test_trie_find_containing(cidrs, query, expected):
+    assert make_trie(*cidrs).find_containing(address(query)) == expected
+
+
+@pytest.mark.parametrize(('cidrs', 'query', 'expected'), [
+    (['10.0.0.0/8', '10.1.0.0/16', '10.2.0.0/16'], '10.1.0.0/16', ['10.0.0.0/8', '10.1.0.0/16']),
+    (['10.1.0.0/16', '10.2.0.0/16', '11.0.0.0/8'], '10.0.0.0/8', ['10.1.0.0/16', '10.2.0.0/16']),
+    (['10.1.0.0/16'], '10.2.0.0/16', []),
+    (['10.1.0.0/16'], '0.0.0.0/0', ['10.1.0.0/16']),
+])
+def test_trie_find_overlapping(cidrs, query, expected):
+    network = Network(query)
+    found = make_trie(*cidrs).find_overlapping(network.first, network.prefixlen)
+    assert sorted(found) == expected
+
+
+#### PoolRangeIndex ###########################################################
+
+
+@pytest.mark.parametrize(('ranges', 'start', 'end', 'expected'), [
+    (['10.0.0.10 10.0.0.20'], '10.0.0.21', '10.0.0.30', None),
+    (['10.0.0.10 10.0.0.20'], '10.0.0.20', '10.0.0.30', '10.0.0.10 10.0.0.20'),
+    (['10.0.0.10 10.0.0.20'], '10.0.0.1', '10.0.0.10', '10.0.0.10 10.0.0.20'),
+    (['10.0.0.10 10.0.0.200', '10.0.0.50 10.0.0.60'], '10.0.0.100', '10.0.0.110', '10.0.0.10 10.0.0.200'),
+    ([], '10.0.0.1', '10.0.0.2', None),
+])
+def test_pool_index_find_overlap(ranges, start, end, expected):
+    found = make_index(*ranges).find_overlap(address(start), address(end))
+    assert (found and found[3]) == expected
+
+
+def test_pool_index_find_overlaps():
+    overlaps = make_index(
+        '10.0.0.10 10.0.0.100', '10.0.0.50 10.0.0.60', '10.0.0.90 10.0.0.110',
+        '10.0.0.200 10.0.0.210').find_overlaps()
+    assert [(a[3], b[3]) for (a, b) in overlaps] == [
+        ('10.0.0.10 10.0.0.100', '10.0.0.50 10.0.0.60'),
+        ('10.0.0.10 10.0.0.100', '10.0.0.90 10.0.0.110'),
+    ]
+
+
+#### dhcpd.leases #############################################################
+
+
+leases_file = u'''\
+# The format of this file is documented in the dhcpd.leases(5) manual page.
+lease 10.0.0.100 {
+  starts 4 2016/10/06 17:41:51;
+  ends 4 2016/10/06 18:41:51;
+  binding state active;
+  hardware ethernet 00:1a:2b:3c:4d:5e;
+}
+lease 10.0.0.101 {
+  ends never;
+  binding state free; # comment
+}
+lease 10.0.0.102 {
+  ends epoch 1475775711;
+  binding state backup;
+'''
+
+
+def test_iter_dhcpd_leases():
+    assert list(dhcputil.iter_dhcpd_leases(dhcputil.iter_text_lines(leases_file))) == [
+        dict(address='10.0.0.100', state='active', ends=1475779311, hwaddress='00:1A:2B:3C:4D:5E'),
+        dict(address='10.0.0.101', state='free', ends=None, hwaddress=None),
+    ]
+
+
+@pytest.mark.parametrize(('text', 'expected'), [
+    (u'', []),
+    (u'a', [u'a']),
+    (u'a\n', [u'a']),
+    (u'a\n\nb', [u'a', u'', u'b']),
+])
+def test_iter_text_lines(text, expected):
+    assert list(dhcputil.iter_text_lines(text)) == expected
+
+
+#### MAC addresses ############################################################
+
+
+@pytest.mark.parametrize(('value', 'expected'), [
+    (u'00:1a:2b:3c:4d:5e', u'00:1A:2B:3C:4D:5E'),
+    (u'00-1A-2B-3C-4D-5E', u'00:1A:2B:3C:4D:5E'),
+    (u'001a2b3c4d5e', u'00:1A:2B:3C:4D:5E'),
+    (u' 00:1a:2b:3c:4d:5e ', u'00:1A:2B:3C:4D:5E'),
+    (u'00:1a:2b:3c:4d', u'00:1a:2b:3c:4d'),
+    (u'not a mac', u'not a mac'),
+])
+def test_normalize_macaddress(value, expected):
+    assert dhcputil.normalize_macaddress(value) == expected
+
+
+#### Kea ######################################################################
+
+
+@pytest.mark.parametrize(('cidrs', 'expected'), [
+    (['10.0.0.0/24', '10.0.1.0/24'], [address('10.0.0.0'), address('10.0.1.0')]),
+    (['0.0.0.0/8'], [1]),
+    (['0.0.0.0/8', '0.0.0.1/32'], [2, 1]),
+    (['255.255.255.255/32'], [1]),
+    (['255.255.255.254/32', '255.255.255.255/32'], [2 ** 32 - 2, 1]),
+])
+def test_kea_subnet_ids(cidrs, expected):
+    networks = [Network(c) for c in cidrs]
+    ids = dhcputil.get_kea_subnet_ids(networks)
+    assert [ids[n] for n in networks] == expected
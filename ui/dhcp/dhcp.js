@@ -134,6 +134,49 @@ define(
         }
 
 
+        IPA.dhcp.dhcppool_search_facet = function(spec) {
+            spec = spec || {};
+            var that = IPA.nested_search_facet(spec);
+
+            // Load the pools of a subnet with a single dhcpsubnet_show
+            // --all-pools call, which also returns the subnet's utilization,
+            // and hand them to the table as if they came from dhcppool_find.
+
+            that.create_refresh_command = function() {
+                return rpc.command({
+                    entity: 'dhcpsubnet',
+                    method: 'show',
+                    args: that.get_pkeys(),
+                    options: { all_pools: true }
+                });
+            };
+
+            that.format_usage = function(usage) {
+                if (!usage) return '';
+                return usage.total + ' addresses, ' +
+                    usage.pooled + ' in pools, ' +
+                    usage.fixed + ' fixed (' + usage.fixedinpools + ' inside pools), ' +
+                    usage.free + ' free';
+            };
+
+            that.nested_search_facet_load = that.load;
+            that.load = function(data) {
+                var pools = data.result.pools || [];
+                that.usage = data.result.usage;
+                that.nested_search_facet_load({
+                    result: {
+                        result: pools,
+                        count: pools.length,
+                        truncated: false,
+                        summary: that.format_usage(that.usage)
+                    }
+                });
+            };
+
+            return that;
+        }
+
+
 //// dhcpservice //////////////////////////////////////////////////////////////
 
 
@@ -272,6 +315,7 @@ define(
                     },
                     {
                         $type: 'nested_search',
+                        $factory: IPA.dhcp.dhcppool_search_facet,
                         facet_group: 'dhcppoolfacetgroup',
                         nested_entity: 'dhcppool',
                         search_all_entries: true,
@@ -282,6 +326,9 @@ define(
                             {
                                 name: 'cn'
                             },
+                            'defaultleasetime',
+                            'permitknownclients',
+                            'permitunknownclients',
                             'dhcpcomments'
                         ]
                     }